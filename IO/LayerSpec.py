@@ -32,6 +32,9 @@ Manages the set of one or more fields that go into a layer.
 """
 
 import copy
+import time
+from multiprocessing.pool import ThreadPool
+from lookup_table import apply_table, value_range
 
 class LayerSpec(object):
     def __init__(self):
@@ -39,6 +42,10 @@ class LayerSpec(object):
         self.luminance = None
         self.colors = []
         self.values = []
+        self.valueRange = None
+        self._valueExtent = None
+        self.lookupTable = None
+        self.level = 0
         self.dict = {}
         self._fields = {}
 
@@ -51,35 +58,57 @@ class LayerSpec(object):
         #print "ADDQUERY", img_type, fieldname, fieldchoice
         self._fields[img_type] = {fieldname:fieldchoice}
 
+    def queries(self):
+        """
+        Return the (image type, query) pairs that make up this layer.
+        """
+        nfields = len(self._fields)
+        if nfields == 0:
+            #FALLBACK RGB
+            return [('RGB', self.dict)]
+        result = []
+        for f in self._fields.keys():
+            query = copy.deepcopy(self.dict)
+            query.update(self._fields[f])
+            result.append((f, query))
+        return result
+
+    def key(self):
+        """
+        Hashable identity of the images this layer is made of, the same
+        for any two layers that would load the same images.
+        """
+        queries = []
+        for img_type, query in self.queries():
+            queries.append((img_type, tuple(sorted(query.items()))))
+        vrange = None
+        if self.valueRange is not None:
+            vrange = tuple(self.valueRange)
+        return (tuple(sorted(queries)), vrange, self.level)
+
     def loadImages(self, store):
         """
         Take the queries we've been given and get images for them.
         Later call get* to get the images out.
         """
-        nfields = len(self._fields)
-        if nfields == 0:
-            img = list(store.find(self.dict))[0].data
+        for f, query in self.queries():
+            #print "Q", query
+            img = list(store.find(query))[0].data
+            self.setImage(f, img)
+
+    def setImage(self, img_type, img):
+        """ put a loaded image for one of our queries() in its place """
+        if img_type == 'RGB':
+            #print "ADD RGB"
             self._addColor(img)
-            #print "FALLBACK RGB"
-        else:
-            for f in self._fields.keys():
-                query = copy.deepcopy(self.dict)
-                query.update(self._fields[f])
-                #print f
-                #print "Q", query
-                img = list(store.find(query))[0].data
-                #print "I", img
-                if f == 'RGB':
-                    #print "ADD RGB"
-                    self._addColor(img)
-                elif f == 'Z':
-                    #print "ADD DEPTH"
-                    self._setDepth(img)
-                elif f == 'VALUE':
-                    #print "ADD VALUES"
-                    self._addColor(img) #TODO: change to addValues when renderer can handle
-                elif f == 'LUMINANCE':
-                    self._setLuminance(img)
+        elif img_type == 'Z':
+            #print "ADD DEPTH"
+            self._setDepth(img)
+        elif img_type == 'VALUE':
+            #print "ADD VALUES"
+            self._addValues(img)
+        elif img_type == 'LUMINANCE':
+            self._setLuminance(img)
 
     def _setDepth(self, image):
         self.depth = image
@@ -96,13 +125,38 @@ class LayerSpec(object):
         #print image
         #print self.colors
 
+    def setValueRange(self, vrange):
+        """ the (min, max) that the lookup table spans for our values """
+        self.valueRange = vrange
+
+    def setLookupTable(self, lookup_table):
+        """ a table for this layer alone, instead of the compositor's """
+        self.lookupTable = lookup_table
+
+    def getEncoded1(self):
+        """
+        The layer's color image before any lookup table is applied, as
+        (image, values, vrange) to hand to lookup_table.apply_table. Any
+        part of the image is then colored as it would be in the whole.
+        """
+        if len(self.colors) == 0 and len(self.values) > 0:
+            #float values, no need to decode them first
+            vrange = self.valueRange
+            if vrange is None:
+                #scale over the whole image even when colored in parts
+                if self._valueExtent is None:
+                    self._valueExtent = value_range(self.values[0])
+                vrange = self._valueExtent
+            return self.values[0], True, vrange
+        return self.colors[0], False, None
+
     def getColor1(self, lookup_table):
-        if lookup_table is None:
-            return self.colors[0]
-        return lookup_table.recolor(self.colors[0])
+        image, values, vrange = self.getEncoded1()
+        return apply_table(lookup_table, image, vrange, values)
 
     def _addValues(self, image):
         self.values.append(image)
+        self._valueExtent = None
         #print "ADDVALUE"
         #print image
         #print self.values
@@ -115,3 +169,53 @@ class LayerSpec(object):
 
     def getLuminance(self):
         return self.luminance
+
+class LayerLoader(object):
+    """
+    Loads the images for a whole frame's worth of layers at once. Every
+    (layer, field) query is resolved concurrently on a pool of threads,
+    which pays off because PNG and EXR decoding release the GIL.
+    """
+    def __init__(self, workers=4):
+        self._pool = ThreadPool(workers)
+        # (layer index, image type, query, seconds) for the last load
+        self.timings = []
+
+    def close(self):
+        """ Shut the pool's threads down, the loader can not be used after. """
+        self._pool.close()
+        self._pool.join()
+
+    def load(self, store, layers, level=0, skip=None):
+        """
+        Load the images of every layer, returns when all of them are ready.
+        level > 0 asks the store for images at 1/2**level resolution.
+        skip, if given, is called with each layer and returns True for the
+        layers whose images are not needed, e.g. Compositor.is_cached.
+        """
+        tasks = []
+        for idx, layer in enumerate(layers):
+            layer.level = level
+            if skip is not None and skip(layer):
+                continue
+            for img_type, query in layer.queries():
+                tasks.append((idx, img_type, query))
+
+        def fetch(task):
+            start = time.time()
+            if level:
+                img = next(store.find(task[2], level=level)).data
+            else:
+                img = next(store.find(task[2])).data
+            return img, time.time() - start
+
+        results = self._pool.map(fetch, tasks)
+
+        timings = []
+        #fill layers in the same order loadImages would have
+        for task, result in zip(tasks, results):
+            idx, img_type, query = task
+            layers[idx].setImage(img_type, result[0])
+            timings.append((idx, img_type, query, result[1]))
+        self.timings = timings
+        return layers
@@ -37,6 +37,14 @@ import os.path
 import re
 import itertools
 import weakref
+import threading
+import collections
+import Queue
+import io
+import mmap
+import hashlib
+import sqlite3
+from multiprocessing.pool import ThreadPool
 import PIL.Image
 import numpy as np
 import copy
@@ -59,10 +67,14 @@ class Document(object):
     A document can have arbitrary data (as 'data') and meta-data (as
     'attributes') associated with it. At the moment we are assuming
     stored images and are ignoring the attributes.
+
+    Documents that stores return are usually given a loader instead of
+    data, a function that reads the data when it is first asked for.
     """
-    def __init__(self, descriptor, data=None):
+    def __init__(self, descriptor, data=None, loader=None):
         self.__descriptor = descriptor
         self.__data = data
+        self.__loader = loader
         self.__attributes = None
 
     @property
@@ -74,12 +86,35 @@ class Document(object):
 
     @property
     def data(self):
-        """Data associated with the document."""
+        """Data associated with the document, read by the loader on first access."""
+        if self.__data is None and self.__loader is not None:
+            self.__data = self.__loader()
         return self.__data
 
     @data.setter
     def data(self, val):
         self.__data = val
+        self.__loader = None
+
+    @property
+    def loaded(self):
+        """Whether the data is in memory."""
+        return self.__data is not None
+
+    @property
+    def missing(self):
+        """Whether there is no data at all, known without reading any."""
+        return self.__data is None and self.__loader is None
+
+    def load(self):
+        """Reads the data now rather than on first access, returns it."""
+        return self.data
+
+    def release(self):
+        """Lets go of the data, it is read again if it is asked for later.
+        Documents without a loader keep theirs."""
+        if self.__loader is not None:
+            self.__data = None
 
     @property
     def attributes(self):
@@ -93,6 +128,44 @@ class Document(object):
     def attributes(self, attrs):
         self.__attributes = attrs
 
+class Predicate(object):
+    """
+    Base for query values that match more than one parameter value.
+    A query passed to find may map a parameter to a Predicate, or to a
+    set, list or tuple of values (shorthand for OneOf), instead of a
+    single value.
+    """
+    def matches(self, value):
+        raise RuntimeError("Subclasses must define this method")
+
+class Range(Predicate):
+    """ matches values from low to high inclusive, None leaves a side open """
+    def __init__(self, low=None, high=None):
+        self.low = low
+        self.high = high
+
+    def matches(self, value):
+        if self.low is not None and value < self.low:
+            return False
+        if self.high is not None and value > self.high:
+            return False
+        return True
+
+class OneOf(Predicate):
+    """ matches any of the given values """
+    def __init__(self, values):
+        self.values = list(values)
+
+    def matches(self, value):
+        return value in self.values
+
+class _Any(Predicate):
+    """ matches any value, but the parameter must be in the descriptor """
+    def matches(self, value):
+        return True
+
+ANY = _Any()
+
 class Store(object):
     """
     API for cinema stores. A store is a collection of Documents,
@@ -123,6 +196,7 @@ class Store(object):
         self.__parameter_associations = {}
         self.__view_associations = {}
         self.__type_specs = {}
+        self.__graphs = {}
 
     @property
     def parameter_list(self):
@@ -137,10 +211,14 @@ class Store(object):
             Zs = self.__type_specs['Z']
         else:
             Zs = []
-        if 'luminance' in self.__type_specs:
+        if 'LUMINANCE' in self.__type_specs:
             Ls = self.__type_specs['LUMINANCE']
         else:
             Ls = []
+        if 'VALUE' in self.__type_specs:
+            Vs = self.__type_specs['VALUE']
+        else:
+            Vs = []
         if 'types' in properties:
             for x in range(0, len(properties['types'])):
                 if properties['types'][x] == 'depth':
@@ -151,16 +229,30 @@ class Store(object):
                     value = properties['values'][x]
                     newentry = [name, value]
                     Ls.append(newentry)
+                if properties['types'][x] == 'floatvalue':
+                    value = properties['values'][x]
+                    newentry = [name, value]
+                    Vs.append(newentry)
         if len(Zs) > 0:
             self.__type_specs['Z'] = Zs
         if len(Ls) > 0:
             self.__type_specs['LUMINANCE'] = Ls
+        if len(Vs) > 0:
+            self.__type_specs['VALUE'] = Vs
 
     def _set_parameter_list(self, val):
         """For use by subclasses alone"""
         self.__parameter_list = val
         for name in self.__parameter_list:
             self._parse_parameter_type(name, self.__parameter_list[name])
+        self._parameters_changed()
+
+    def _parameters_changed(self):
+        """
+        Called whenever parameters or associations among them change.
+        Subclasses extend this to drop anything they derived from them.
+        """
+        self.__graphs = {}
 
     def add_parameter(self, name, properties):
         """Add a parameter.
@@ -174,6 +266,7 @@ class Store(object):
         # I postulate it is always OK to add safely to outermost parameter (loop).
         self.__parameter_list[name] = properties
         self._parse_parameter_type(name, properties)
+        self._parameters_changed()
 
     def get_parameter(self, name):
         return self.__parameter_list[name]
@@ -215,6 +308,7 @@ class Store(object):
     def _set_parameter_associations(self, val):
         """For use by subclasses alone"""
         self.__parameter_associations = val
+        self._parameters_changed()
 
     @property
     def view_associations(self):
@@ -223,6 +317,7 @@ class Store(object):
     def _set_view_associations(self, val):
         """For use by subclasses alone"""
         self.__view_associations = val
+        self._parameters_changed()
 
     @property
     def metadata(self):
@@ -267,9 +362,79 @@ class Store(object):
         for doc in store.find({'phi': 0, 'theta': 100}):
             print doc.data
 
+        Stores that support predicates (see compile_query) also take
+        ranges, sets and wildcards e.g.
+
+        for doc in store.find({'time': Range(10, 20), 'phi': set([0, 90])}):
+            print doc.data
+        for doc in store.find({'colorContour': ANY}):
+            print doc.data
+
+        Stores that keep reduced resolution copies also take level=k to
+        get images at 1/2**k resolution.
         """
         raise RuntimeError("Subclasses must define this method")
 
+    def count(self, q=None):
+        """
+        Return the number of documents that match query q.
+        Subclasses that can tell without reading the documents override this.
+        """
+        n = 0
+        for doc in self.find(q):
+            n = n + 1
+        return n
+
+    @staticmethod
+    def has_predicates(q):
+        """ check if query q asks for anything other than exact values """
+        for value in q.itervalues():
+            if isinstance(value, (Predicate, set, frozenset, list, tuple)):
+                return True
+        return False
+
+    def compile_query(self, q):
+        """
+        Evaluate the predicates in query q against the values of each
+        parameter once. Returns a dict mapping each parameter named in q to
+        a boolean numpy array with one entry per value in the parameter's
+        'values' list, or None if q names a parameter the store lacks.
+        """
+        masks = {}
+        for name, pred in q.iteritems():
+            if not name in self.parameter_list:
+                return None
+            if isinstance(pred, (set, frozenset, list, tuple)):
+                pred = OneOf(pred)
+            vals = self.get_parameter(name)['values']
+            if isinstance(pred, Predicate):
+                mask = [pred.matches(v) for v in vals]
+            else:
+                mask = [v == pred for v in vals]
+            masks[name] = np.array(mask, dtype=bool)
+        return masks
+
+    def find_many(self, queries=None, fields=None, workers=4):
+        """
+        Bulk version of find for analysis scripts. queries is either one
+        (partial) query or a list of them. fields, if given, is a list of
+        document types (see determine_type) to keep, e.g. ['RGB'].
+
+        Returns an (N, H, W, C) array holding the data of every matching
+        document (C is 1 for single channel images) and the list of the N
+        matching descriptors in the same order. All matches must have the
+        same shape and data type.
+        """
+        raise RuntimeError("Subclasses must define this method")
+
+    @staticmethod
+    def _as_queries(queries):
+        if queries is None:
+            return [{}]
+        if isinstance(queries, dict):
+            return [queries]
+        return queries
+
     def insert(self, document):
         """
         Inserts a new document.
@@ -278,6 +443,14 @@ class Store(object):
         if not self.__loaded:
             self.create()
 
+    def flush(self):
+        """
+        Waits until every document given to insert() has been written.
+        Stores that write in the background extend this, and re-raise
+        here the first error that a pending write ran into.
+        """
+        pass
+
     def assign_parameter_dependence(self, dep_param, param, on_values):
         """
         mark a particular parameter as being explorable only for a subset
@@ -291,6 +464,7 @@ class Store(object):
         """
         self.__parameter_associations.setdefault(dep_param, {}).update(
         {param: on_values})
+        self._parameters_changed()
 
     def assign_view_dependence(self, dep_param, param, on_values):
         """
@@ -305,6 +479,7 @@ class Store(object):
         """
         self.__view_associations.setdefault(dep_param, {}).update(
         {param: on_values})
+        self._parameters_changed()
 
     def isdepender(self, name):
         """ check if the named parameter depends on any others """
@@ -314,10 +489,7 @@ class Store(object):
 
     def isdependee(self, name):
         """ check if the named parameter has others that depend on it """
-        for depender, dependees in self.parameter_associations.iteritems():
-            if name in dependees:
-                return True
-        return False
+        return self.dependency_graph().isdependee(name)
 
     def isviewdepender(self, name):
         """ check if the named parameter depends on any others """
@@ -327,26 +499,30 @@ class Store(object):
 
     def isviewdependee(self, name):
         """ check if the named parameter has others that depend on it """
-        for depender, dependees in self.view_associations.iteritems():
-            if name in dependees:
-                return True
-        return False
+        return self.dependency_graph(forGUI=True).isdependee(name)
 
     def getdependers(self, name):
         """ return a list of all the parameters that depend on the given one """
-        result = []
-        for depender, dependees in self.parameter_associations.iteritems():
-            if name in dependees:
-                result.append(depender)
-        return result
+        return self.dependency_graph().getdependers(name)
 
     def getviewdependers(self, name):
         """ return a list of all the parameters that depend on the given one """
-        result = []
-        for depender, dependees in self.view_associations.iteritems():
-            if name in dependees:
-                result.append(depender)
-        return result
+        return self.dependency_graph(forGUI=True).getdependers(name)
+
+    def dependency_graph(self, forGUI=False):
+        """
+        Returns the DependencyGraph compiled from the parameter (or with
+        forGUI the view) associations. It is built the first time it is
+        asked for and kept until parameters or associations change through
+        the store's methods.
+        """
+        graph = self.__graphs.get(forGUI)
+        if graph is None:
+            associations = self.__view_associations if forGUI \
+                    else self.__parameter_associations
+            graph = DependencyGraph(associations)
+            self.__graphs[forGUI] = graph
+        return graph
 
     def dependencies_satisfied(self, dep_param, descriptor):
         """
@@ -355,19 +531,7 @@ class Store(object):
         Return true if no dependencies to satisfy.
         Return false if dependency of dependency fails.
         """
-        if not dep_param in self.__parameter_associations:
-            return True
-        for dep in self.__parameter_associations[dep_param]:
-            if not dep in descriptor:
-                #something dep_param needs is not in the descriptor at all
-                return False
-            if not descriptor[dep] in self.__parameter_associations[dep_param][dep]:
-                #something dep_param needs doesn't have an accepted value in the descriptor
-                return False
-            if not self.dependencies_satisfied(dep, descriptor):
-                #recurse to check deps of dep_param themselves
-                return False
-        return True
+        return self.dependency_graph().satisfied(dep_param, descriptor)
 
     def view_dependencies_satisfied(self, dep_param, descriptor):
         """
@@ -376,19 +540,15 @@ class Store(object):
         Return true if no dependencies to satisfy.
         Return false if dependency of dependency fails.
         """
-        if not dep_param in self.__view_associations:
-            return True
-        for dep in self.__view_associations[dep_param]:
-            if not dep in descriptor:
-                #something dep_param needs is not in the descriptor at all
-                return False
-            if not descriptor[dep] in self.__view_associations[dep_param][dep]:# and not ('layer' in dep_param and 'layer' in dep):
-                #something dep_param needs doesn't have an accepted value in the descriptor
-                return False
-            if not self.view_dependencies_satisfied(dep, descriptor):
-                #recurse to check deps of dep_param themselves
-                return False
-        return True
+        return self.dependency_graph(forGUI=True).satisfied(dep_param, descriptor)
+
+    def view_dependencies_satisfiable(self, dep_param, choices):
+        """
+        Check if any combination of the candidate values in choices, a
+        dictionary of parameter name to a collection of values, satisfies
+        all of the view dependencies of dep_param.
+        """
+        return self.dependency_graph(forGUI=True).satisfiable(dep_param, choices)
 
     def add_layer(self, name, properties):
         """
@@ -437,96 +597,803 @@ class Store(object):
         Parameters, if supplied, is a list of parameter names to enforce an ordering.
         Fixed arguments, if supplied, are parameter/value pairs that we want
         to hold constant in the exploration.
+
+        The combinations are walked as a tree. A parameter is only branched
+        on when everything it depends on already has a value it accepts, so
+        each valid descriptor is produced exactly once and only the current
+        path through the tree is held in memory. Parameters are visited in
+        the given order, except that a parameter is put off until the ones it
+        depends on have been visited.
         """
+        associations = self.view_associations if forGUI \
+                else self.parameter_associations
+        fixedargs = fixedargs if fixedargs else {}
 
         #prepare to iterate through all the possibilities, in order if one is given
-        #param_names = parameters if parameters else sorted(self.parameter_list.keys())
         param_names = parameters if parameters else self.parameter_list.keys()
-        #print "PARAMETERS", param_names
-        params = []
-        values = []
-        dep_params = []
+        names = []
+        choices = {}
+        for name, value in fixedargs.iteritems():
+            names.append(name)
+            choices[name] = [value]
         for name in param_names:
             vals = self.get_parameter(name)['values']
-            if fixedargs and name in fixedargs:
+            if name in fixedargs:
+                continue
+            if len(vals) == 0:
+                #nothing to combine with
+                return
+            names.append(name)
+            choices[name] = vals
+
+        order = self._dependency_order(names, associations)
+
+        def accepted(name, descriptor):
+            for dep, on_values in associations.get(name, {}).iteritems():
+                if not dep in descriptor:
+                    return False
+                if not descriptor[dep] in on_values:
+                    return False
+            return True
+
+        #'skip' stands in for a parameter whose dependencies are not met
+        skip = object()
+        def branches(name, descriptor):
+            if accepted(name, descriptor):
+                return iter(choices[name])
+            if name in fixedargs:
+                #the value we were asked to hold can not be reached from here
+                return iter([])
+            return iter([skip])
+
+        if len(order) == 0:
+            yield {}
+            return
+
+        descriptor = {}
+        stack = [branches(order[0], descriptor)]
+        while stack:
+            level = len(stack) - 1
+            name = order[level]
+            try:
+                value = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                descriptor.pop(name, None)
                 continue
-            params.append(name)
-            values.append(vals)
-
-        #the algorithm is to iterate through all combinations, and remove
-        #the impossible ones. I use a set to avoid redundant combinations.
-        #In order to use the set I serialize to make something hashable.
-        #Then I insert into a list to preserve the (hopefully optimized) order.
-        ok_descs = set()
-        ordered_descs = []
-        for element in itertools.product(*values):
-            descriptor = dict(itertools.izip(params, element))
-
-            if fixedargs != None:
-                descriptor.update(fixedargs)
-            ok_params = []
-            ok_vals = []
-
-            ok_desc = {}
-            for param, value in descriptor.iteritems():
-                if forGUI:
-                    if self.view_dependencies_satisfied(param, descriptor):
-                        ok_desc.update({param:value})
-                else:
-                    if self.dependencies_satisfied(param, descriptor):
-                        ok_desc.update({param:value})
-
-            OK = True
-            if fixedargs:
-                for k,v in fixedargs.iteritems():
-                    if not (k in ok_desc and ok_desc[k] == v):
-                        OK = False
-            if OK:
-                strval = json.dumps(ok_desc, sort_keys=True)
-                if not strval in ok_descs:
-                    ok_descs.add(strval)
-                    ordered_descs.append(ok_desc)
-
-        for descriptor in ordered_descs:
-            yield descriptor
+            if value is skip:
+                descriptor.pop(name, None)
+            else:
+                descriptor[name] = value
+            if level + 1 == len(order):
+                yield dict(descriptor)
+            else:
+                stack.append(branches(order[level + 1], descriptor))
+
+    @staticmethod
+    def _dependency_order(names, associations):
+        """
+        Reorder names so that every parameter comes after the ones it depends
+        on, otherwise keeping the original order.
+        """
+        known = set(names)
+        pending = list(names)
+        order = []
+        placed = set()
+        while pending:
+            for idx, name in enumerate(pending):
+                deps = associations.get(name, {})
+                if all(dep in placed or not dep in known for dep in deps):
+                    break
+            else:
+                raise RuntimeError, \
+                    "Circular dependency among parameters %s" % str(pending)
+            order.append(name)
+            placed.add(name)
+            del pending[idx]
+        return order
+
+def downsample(data, doctype, levels=1):
+    """
+    Halve the resolution of a document's data, levels times over. Luminance
+    is box filtered. Everything else is sampled, which keeps depths, values
+    and colors that encode values exact. Either way an H x W image becomes
+    ceil(H/2**levels) x ceil(W/2**levels).
+    """
+    if levels == 0 or not isinstance(data, np.ndarray):
+        return data
+    step = 2 ** levels
+    if doctype != 'LUMINANCE':
+        return data[::step, ::step]
+    h = -(-data.shape[0] // step)
+    w = -(-data.shape[1] // step)
+    pad = [(0, h*step - data.shape[0]), (0, w*step - data.shape[1])]
+    pad = pad + [(0, 0)] * (data.ndim - 2)
+    blocks = np.pad(data, pad, mode='edge')
+    blocks = blocks.reshape((h, step, w, step) + data.shape[2:])
+    return blocks.mean(axis=(1, 3)).astype(data.dtype)
+
+def _stack_documents(descriptors, load, workers):
+    """
+    Fill one preallocated (N, H, W, C) array with the data of each of the
+    N descriptors, where load(i) returns the data of descriptors[i].
+    The first document sets the shape, the rest are loaded in parallel.
+    """
+    if len(descriptors) == 0:
+        return np.zeros((0, 0, 0, 0), np.uint8)
+
+    def fetch(i):
+        data = load(i)
+        if data is None:
+            raise RuntimeError, "No data for document %s" % str(descriptors[i])
+        data = np.asarray(data)
+        if data.ndim == 2:
+            data = data[:, :, np.newaxis]
+        return data
+
+    first = fetch(0)
+    result = np.empty((len(descriptors),) + first.shape, first.dtype)
+    result[0] = first
+
+    def fill(i):
+        data = fetch(i)
+        if data.shape != first.shape or data.dtype != first.dtype:
+            raise RuntimeError, \
+                "Document %s does not match the shape and type of %s" % \
+                (str(descriptors[i]), str(descriptors[0]))
+        result[i] = data
+
+    if len(descriptors) > 1:
+        pool = ThreadPool(workers)
+        try:
+            pool.map(fill, range(1, len(descriptors)))
+        finally:
+            pool.close()
+    return result
+
+class DependencyGraph(object):
+    """
+    The associations among a store's parameters compiled for repeated
+    lookups. Holds who depends on each parameter, every parameter that
+    each one depends on directly or through others, and for each
+    depender the flattened list of value checks that a descriptor has to
+    pass, so asking whether a parameter's dependencies are satisfied
+    does not have to walk the associations again.
+    """
+    def __init__(self, associations):
+        self.associations = associations
+        self.dependers = {}
+        for depender, dependees in associations.iteritems():
+            for dep in dependees:
+                self.dependers.setdefault(dep, []).append(depender)
+        self.closure = {}
+        self._checks = {}
+        for name in associations:
+            self._compile(name)
+        self._order = None
+
+    @staticmethod
+    def _accepted_values(on_values):
+        """ a set when the values allow one, for quick membership tests """
+        if isinstance(on_values, basestring):
+            return on_values
+        try:
+            return frozenset(on_values)
+        except TypeError:
+            return on_values
+
+    def _compile(self, name):
+        #walk everything name depends on, tolerating cycles
+        reached = []
+        seen = set([name])
+        pending = [name]
+        while pending:
+            current = pending.pop(0)
+            reached.append(current)
+            for dep in self.associations.get(current, {}):
+                if not dep in seen:
+                    seen.add(dep)
+                    pending.append(dep)
+        checks = collections.OrderedDict()
+        for current in reached:
+            for dep, on_values in self.associations.get(current, {}).iteritems():
+                checks.setdefault(dep, []).append(
+                    self._accepted_values(on_values))
+        self.closure[name] = frozenset(reached[1:])
+        self._checks[name] = checks.items()
+
+    @property
+    def order(self):
+        """
+        Every parameter that takes part in an association, each one after
+        all of those it depends on.
+        """
+        if self._order is None:
+            names = []
+            for depender, dependees in self.associations.iteritems():
+                for name in [depender] + list(dependees):
+                    if not name in names:
+                        names.append(name)
+            self._order = Store._dependency_order(names, self.associations)
+        return self._order
+
+    def isdependee(self, name):
+        return name in self.dependers
+
+    def getdependers(self, name):
+        return list(self.dependers.get(name, []))
+
+    def satisfied(self, name, descriptor):
+        """
+        True when descriptor gives an accepted value to everything that
+        name depends on, directly or through others.
+        """
+        for dep, accepted in self._checks.get(name, ()):
+            if not dep in descriptor:
+                return False
+            value = descriptor[dep]
+            for on_values in accepted:
+                if not value in on_values:
+                    return False
+        return True
+
+    def satisfiable(self, name, choices):
+        """
+        True when some combination of the values in choices, a dictionary
+        of name to the candidate values for it, satisfies the dependencies
+        of name. Each check concerns a single parameter, so it is enough to
+        find one candidate per parameter that passes all of its checks.
+        """
+        for values in choices.itervalues():
+            if len(values) == 0:
+                #there are no combinations at all
+                return False
+        for dep, accepted in self._checks.get(name, ()):
+            if not dep in choices:
+                return False
+            for value in choices[dep]:
+                if all(value in on_values for on_values in accepted):
+                    break
+            else:
+                return False
+        return True
+
+class DescriptorIndex(object):
+    """
+    Lookup table from every descriptor a store can produce to the file and
+    document type that hold it. Exact descriptors are found with a single
+    dictionary lookup. Partial queries are answered from per name/value
+    postings, so only the entries that share the rarest of the query's
+    values are ever examined. Entries keep the order they were added in.
+    """
+    def __init__(self):
+        self._entries = []
+        self._positions = {}
+        self._postings = {}
+
+    @staticmethod
+    def key(desc):
+        """ hashable, order independent form of a descriptor """
+        return tuple(sorted(desc.items()))
+
+    def add(self, desc, filename, doctype):
+        position = len(self._entries)
+        self._entries.append((desc, filename, doctype))
+        self._positions[self.key(desc)] = position
+        for name, value in desc.iteritems():
+            self._postings.setdefault((name, value), []).append(position)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, desc):
+        """ return the (descriptor, filename, type) entry for desc or None """
+        position = self._positions.get(self.key(desc))
+        if position is None:
+            return None
+        return self._entries[position]
+
+    def select(self, q):
+        """
+        Return the entries whose descriptors contain every name/value pair
+        in q, in the order they were added.
+        """
+        if not q:
+            return list(self._entries)
+        entry = self.get(q)
+        if entry is not None:
+            #an exact descriptor can not be a subset of any other one
+            return [entry]
+        postings = []
+        for pair in q.iteritems():
+            posting = self._postings.get(pair)
+            if posting is None:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        result = []
+        for position in postings[0]:
+            entry = self._entries[position]
+            desc = entry[0]
+            for name, value in q.iteritems():
+                if not (name in desc and desc[name] == value):
+                    break
+            else:
+                result.append(entry)
+        return result
+
+    def select_accepted(self, accepted):
+        """
+        Like select, but accepted maps each parameter name to the list of
+        values it may take instead of a single one.
+        """
+        if not accepted:
+            return list(self._entries)
+        #start from the parameter that the fewest entries can satisfy
+        cheapest = None
+        for name, values in accepted.iteritems():
+            postings = [self._postings.get((name, v), []) for v in values]
+            count = sum(len(posting) for posting in postings)
+            if cheapest is None or count < cheapest[1]:
+                cheapest = (name, count, postings)
+        name, count, postings = cheapest
+        if count == 0:
+            return []
+        positions = sorted(itertools.chain(*postings))
+        others = [(other, set(values)) for other, values in accepted.iteritems()
+                  if other != name]
+        result = []
+        for position in positions:
+            entry = self._entries[position]
+            desc = entry[0]
+            for name, values in others:
+                if not (name in desc and desc[name] in values):
+                    break
+            else:
+                result.append(entry)
+        return result
+
+class DecodeCache(object):
+    """
+    Least recently used cache of decoded document data, bounded by the
+    number of bytes it holds rather than the number of entries. Keys are
+    (filename, document type) pairs. Arrays are marked read-only when
+    they are cached because every later hit hands back the same object.
+    Safe to share between stores and threads.
+    """
+    def __init__(self, max_bytes=256*1024*1024):
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._byfile = {}
+        self._max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self):
+        """ byte budget, least recently used entries go once it is exceeded """
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, val):
+        with self._lock:
+            self._max_bytes = val
+            self._evict()
+
+    @staticmethod
+    def _sizeof(data):
+        if isinstance(data, np.ndarray):
+            return data.nbytes
+        if isinstance(data, basestring):
+            return len(data)
+        return 0
+
+    def get(self, key):
+        """ return the cached data for key, or None """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, data):
+        """ cache data under key, returns the (now read-only) data """
+        if isinstance(data, np.ndarray):
+            data.flags.writeable = False
+        nbytes = self._sizeof(data)
+        with self._lock:
+            self._remove(key)
+            if nbytes > self._max_bytes:
+                return data
+            self._entries[key] = (data, nbytes)
+            self._byfile.setdefault(key[0], set()).add(key)
+            self.nbytes += nbytes
+            self._evict()
+        return data
+
+    def discard(self, filename):
+        """ forget everything cached for filename, e.g. when it is rewritten """
+        with self._lock:
+            for key in list(self._byfile.get(filename, [])):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._byfile.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """ counters and occupancy, for tuning the budget """
+        with self._lock:
+            return dict(hits = self.hits,
+                        misses = self.misses,
+                        evictions = self.evictions,
+                        entries = len(self._entries),
+                        nbytes = self.nbytes,
+                        max_bytes = self._max_bytes)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.nbytes -= entry[1]
+        keys = self._byfile[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._byfile[key[0]]
+        return True
+
+    def _evict(self):
+        while self.nbytes > self._max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+#decoded images shared by every FileStore unless given another cache
+decode_cache = DecodeCache()
+
+class BackgroundWriter(object):
+    """
+    Runs write jobs on a pool of threads fed from a bounded queue.
+    submit() blocks while queue_size jobs are already waiting, so a
+    producer can not get more than that far ahead of the disk. The first
+    error a job raises is kept and re-raised by the next submit() or
+    flush(), jobs submitted after it are dropped.
+    """
+    def __init__(self, workers=2, queue_size=8):
+        self._queue = Queue.Queue(queue_size)
+        self._error = None
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, func, *args):
+        """ queue func(*args), waiting for room if the queue is full """
+        self._raise()
+        self._queue.put((func, args))
+
+    def flush(self):
+        """ wait for every queued job to finish """
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        """ flush and stop the threads """
+        try:
+            self.flush()
+        finally:
+            for t in self._threads:
+                self._queue.put(None)
+            for t in self._threads:
+                t.join()
+            self._threads = []
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    job[0](*job[1])
+            except Exception:
+                if self._error is None:
+                    self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error[0], error[1], error[2]
+
+class MetadataJournal(object):
+    """
+    Keeps a store's info.json up to date by appending what changed to
+    info.json.journal, one JSON record per line, instead of rewriting the
+    whole file on every save. Adding values to a parameter, the usual case
+    when time steps arrive during a run, is a single short record. Every
+    record is safe to apply twice, and an incomplete last line (a crash
+    mid-append) is ignored. Once limit records pile up they are folded
+    back into info.json, which is replaced atomically. Stores fold them
+    back on flush() as well, so that readers which only know info.json
+    see a finished run as it ended.
+    """
+    def __init__(self, dbfilename, limit=1000):
+        self.dbfilename = dbfilename
+        self.limit = limit
+        self._snapshot = None
+        self._records = 0
+        self._good_length = None
+
+    @property
+    def journal_filename(self):
+        return self.dbfilename + ".journal"
+
+    def read(self):
+        """ returns the contents of info.json with the journal applied """
+        with open(self.dbfilename, mode="rb") as file:
+            info_json = json.load(file)
+        self._records = 0
+        self._good_length = None
+        try:
+            with open(self.journal_filename, mode="rb") as file:
+                lines = file.readlines()
+        except IOError:
+            lines = []
+        offset = 0
+        for i, line in enumerate(lines):
+            try:
+                if not line.endswith("\n"):
+                    raise ValueError
+                record = json.loads(line)
+            except ValueError:
+                if i != len(lines) - 1:
+                    raise RuntimeError, \
+                        "Corrupt record %d in %s" % (i, self.journal_filename)
+                #torn by a crash while appending, drop it at the next write
+                self._good_length = offset
+                break
+            self._apply(info_json, record)
+            self._records += 1
+            offset += len(line)
+        self._snapshot = self._normalize(info_json)
+        return info_json
+
+    def write(self, info_json):
+        """ records info_json, appending only what changed since last time """
+        info_json = self._normalize(info_json)
+        if self._snapshot is None or self._records >= self.limit:
+            self.compact(info_json)
+            return
+        records = self._diff(self._snapshot, info_json)
+        if records:
+            with open(self.journal_filename, mode="ab") as file:
+                if self._good_length is not None:
+                    file.truncate(self._good_length)
+                    self._good_length = None
+                for record in records:
+                    file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self._records += len(records)
+        self._snapshot = info_json
+
+    def fold(self):
+        """ folds what the journal holds back into info.json """
+        if self._snapshot is None:
+            return
+        if self._records or self._good_length is not None or \
+                os.path.exists(self.journal_filename):
+            self.compact(self._snapshot)
+
+    def compact(self, info_json):
+        """ rewrites info.json as info_json and empties the journal """
+        info_json = self._normalize(info_json)
+        tmpname = self.dbfilename + ".tmp"
+        with open(tmpname, mode="wb") as file:
+            json.dump(info_json, file)
+            file.flush()
+            os.fsync(file.fileno())
+        if os.name == 'nt' and os.path.exists(self.dbfilename):
+            os.remove(self.dbfilename)
+        os.rename(tmpname, self.dbfilename)
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+        self._snapshot = info_json
+        self._records = 0
+        self._good_length = None
+
+    @staticmethod
+    def _normalize(info_json):
+        #what json would give back, so tuples and lists compare equal
+        return json.loads(json.dumps(info_json))
+
+    @staticmethod
+    def _appended(old, new):
+        """ check if parameter new is old with more values on the end """
+        if sorted(old.keys()) != sorted(new.keys()):
+            return False
+        for key in old:
+            if key != 'values' and old[key] != new[key]:
+                return False
+        n = len(old['values'])
+        return len(new['values']) > n and new['values'][:n] == old['values']
+
+    @staticmethod
+    def _diff(old, new):
+        records = []
+        oldargs = old.get('arguments', {})
+        newargs = new['arguments']
+        for name in sorted(newargs):
+            props = newargs[name]
+            prev = oldargs.get(name)
+            if prev == props:
+                continue
+            if prev is not None and MetadataJournal._appended(prev, props):
+                n = len(prev['values'])
+                records.append(dict(op = 'append_values', name = name,
+                                    offset = n, values = props['values'][n:]))
+            else:
+                records.append(dict(op = 'set_parameter', name = name,
+                                    properties = props))
+        for name in sorted(oldargs):
+            if not name in newargs:
+                records.append(dict(op = 'remove_parameter', name = name))
+        for key in sorted(new):
+            if key != 'arguments' and old.get(key) != new[key]:
+                records.append(dict(op = 'set', key = key, value = new[key]))
+        return records
+
+    @staticmethod
+    def _apply(info_json, record):
+        op = record['op']
+        args = info_json.setdefault('arguments', {})
+        if op == 'append_values':
+            values = args[record['name']]['values']
+            del values[record['offset']:]
+            values.extend(record['values'])
+        elif op == 'set_parameter':
+            args[record['name']] = record['properties']
+        elif op == 'remove_parameter':
+            args.pop(record['name'], None)
+        elif op == 'set':
+            info_json[record['key']] = record['value']
+        else:
+            raise RuntimeError, "Unknown journal record %s" % op
 
 class FileStore(Store):
-    """Implementation of a store based on named files and directories."""
+    """
+    Implementation of a store based on named files and directories.
+
+    With dedupe on, every document's content is hashed as it is inserted
+    and each distinct content is written once, to blobs/<hash><ext>.
+    content.json maps the path a document would otherwise have had to its
+    blob, find() resolves through it. Each mapping is appended to
+    content.json.log as it is made and load() adds the logged ones, so
+    save() stays cheap. content.json is rewritten and the log emptied on
+    flush(), or by save() once LOG_LIMIT mappings are in the log.
+
+    manifest.txt lists every document that has been written, one relative
+    path per line appended as each is inserted, so documents that were
+    never produced are answered without touching the disk. Stores written
+    before it existed get one made by listing their directories when they
+    are loaded. find() and count() trust it, call refresh_manifest() to
+    pick up files that another writer added later.
+
+    With pyramid_levels set, each document is also written at 1/2, 1/4 ...
+    resolution under pyramid/<level>/, for find(q, level=k).
+    """
 
-    def __init__(self, dbfilename=None):
+    #log records kept before save() folds them into their json file
+    LOG_LIMIT = 1000
+
+    def __init__(self, dbfilename=None, dedupe=False, pyramid_levels=0):
         super(FileStore, self).__init__()
         self.__filename_pattern = None
         self.__dbfilename = dbfilename if dbfilename \
                 else os.path.join(os.getcwd(), "info.json")
+        self._indices = {}
+        #set to None to decode on every find, or to a private DecodeCache
+        self.decode_cache = decode_cache
+        self._writer = None
+        self._dedupe = dedupe
+        self._content = {}
+        self._content_log = None
+        self._content_logged = 0
+        self._blobs = set()
+        self._content_lock = threading.Lock()
+        self._manifest = set()
+        self._manifest_file = None
+        self._journal = MetadataJournal(self.__dbfilename)
+        self._pyramid_levels = pyramid_levels
+        if dedupe:
+            self.add_metadata({"dedupe" : True})
+        if pyramid_levels:
+            self.add_metadata({"pyramid_levels" : pyramid_levels})
+
+    def _parameters_changed(self):
+        super(FileStore, self)._parameters_changed()
+        self._indices = {}
+
+    def get_index(self, forGUI=False):
+        """
+        Returns the DescriptorIndex for this store, building it from iterate()
+        the first time it is asked for. The index is kept until parameters
+        or associations change.
+        """
+        index = self._indices.get(forGUI)
+        if index is None:
+            index = DescriptorIndex()
+            for desc in self.iterate(forGUI=forGUI):
+                index.add(desc,
+                          self._get_filename(desc),
+                          self.determine_type(desc))
+            self._indices[forGUI] = index
+        return index
 
     def create(self):
         """creates a new file store"""
         super(FileStore, self).create()
         self.save()
+        #keep what an earlier run in the same place recorded
+        self._manifest = self._read_manifest() or set()
 
     def load(self):
         """loads an existing filestore"""
         super(FileStore, self).load()
-        with open(self.__dbfilename, mode="rb") as file:
-            info_json = json.load(file)
-            #for legacy reasons, the parameters are called
-            #arguments" in the files
-            self._set_parameter_list(info_json['arguments'])
-            self.metadata = info_json['metadata']
-            self.filename_pattern = info_json['name_pattern']
-            a = {}
-            if 'associations' in info_json:
-                a = info_json['associations']
-            self._set_parameter_associations(a)
-            va = {}
-            if 'view_associations' in info_json:
-                va = info_json['view_associations']
-            if va == {}:
-                va = copy.deepcopy(a)
-            self._set_view_associations(va)
+        info_json = self._journal.read()
+        #for legacy reasons, the parameters are called
+        #arguments" in the files
+        self._set_parameter_list(info_json['arguments'])
+        self.metadata = info_json['metadata']
+        self.filename_pattern = info_json['name_pattern']
+        a = {}
+        if 'associations' in info_json:
+            a = info_json['associations']
+        self._set_parameter_associations(a)
+        va = {}
+        if 'view_associations' in info_json:
+            va = info_json['view_associations']
+        if va == {}:
+            va = copy.deepcopy(a)
+        self._set_view_associations(va)
+        self._dedupe = bool(self.metadata and self.metadata.get('dedupe'))
+        self._pyramid_levels = 0
+        if self.metadata:
+            self._pyramid_levels = self.metadata.get('pyramid_levels', 0)
+        if self._dedupe:
+            self._content, self._content_logged = self._read_content()
+            self._blobs = set(self._content.values())
+        self._manifest = self._read_manifest()
+        if self._manifest is None:
+            self._manifest = self._scan_manifest()
+            try:
+                self._write_manifest()
+            except IOError:
+                #read only, scan again next time
+                pass
+        self.get_index()
 
     def save(self):
         """ writes out a modified file store """
+        if self._dedupe:
+            with self._content_lock:
+                documents = len(self._content)
+                blobs = len(self._blobs)
+            #documents per distinct blob
+            ratio = float(documents) / blobs if blobs else 1.0
+            self.add_metadata({"dedupe_ratio" : ratio})
         info_json = dict(
                 arguments = self.parameter_list,
                 name_pattern = self.filename_pattern,
@@ -537,8 +1404,168 @@ class FileStore(Store):
         dirname = os.path.dirname(self.__dbfilename)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
-        with open(self.__dbfilename, mode="wb") as file:
-            json.dump(info_json, file)
+        self._journal.write(info_json)
+        self._fold_logs(False)
+
+    def _fold_logs(self, force):
+        """
+        Rewrites the json files that logs are kept for once their logs are
+        long, or with force as soon as they hold anything.
+        """
+        if not self._dedupe:
+            return
+        logged = self._content_logged
+        if logged >= self.LOG_LIMIT or (force and (logged or
+                not os.path.exists(self._content_filename()))):
+            self._write_content()
+
+    def _content_filename(self):
+        return os.path.join(os.path.dirname(self.__dbfilename), "content.json")
+
+    def _read_content(self):
+        """
+        content.json with the logged mappings added, and how many mappings
+        were logged
+        """
+        try:
+            with open(self._content_filename(), mode="rb") as file:
+                content = json.load(file)
+        except IOError:
+            #never saved, the log has it all
+            content = {}
+        logged = self._read_content_log()
+        content.update(logged)
+        return content, len(logged)
+
+    def _read_content_log(self):
+        """ the content mappings appended since content.json was written """
+        content = {}
+        try:
+            with open(self._content_filename() + ".log", mode="rb") as file:
+                for line in file:
+                    try:
+                        rel, blob = json.loads(line)
+                    except ValueError:
+                        #a record cut short by an interrupted writer
+                        continue
+                    content[rel] = blob
+        except IOError:
+            pass
+        return content
+
+    def _write_content(self):
+        """ writes content.json and starts a new log after it """
+        with self._content_lock:
+            tmpname = self._content_filename() + ".tmp"
+            with open(tmpname, mode="wb") as file:
+                json.dump(self._content, file)
+            os.rename(tmpname, self._content_filename())
+            if self._content_log is not None:
+                self._content_log.close()
+            self._content_log = open(self._content_filename() + ".log",
+                                     mode="wb")
+            self._content_logged = 0
+
+    def _manifest_filename(self):
+        return os.path.join(os.path.dirname(self.__dbfilename), "manifest.txt")
+
+    def _read_manifest(self):
+        """ the set of documents in manifest.txt, None if there is none """
+        try:
+            with open(self._manifest_filename(), mode="rb") as file:
+                return set(line.rstrip("\n") for line in file if line.strip())
+        except IOError:
+            return None
+
+    def _write_manifest(self):
+        with self._content_lock:
+            with open(self._manifest_filename(), mode="wb") as file:
+                for rel in sorted(self._manifest):
+                    file.write(self._manifest_line(rel))
+
+    @staticmethod
+    def _manifest_line(rel):
+        if isinstance(rel, unicode):
+            rel = rel.encode('utf-8')
+        return rel + "\n"
+
+    def _add_to_manifest(self, fname):
+        """ records that the document at fname has been written """
+        rel = self._relative(fname)
+        with self._content_lock:
+            if rel in self._manifest:
+                return
+            self._manifest.add(rel)
+            if self._manifest_file is None:
+                self._manifest_file = open(self._manifest_filename(), mode="ab")
+            self._manifest_file.write(self._manifest_line(rel))
+            self._manifest_file.flush()
+
+    def _written(self, fname):
+        """ whether the document at fname has been written """
+        return self._relative(fname) in self._manifest
+
+    def refresh_manifest(self, workers=8):
+        """
+        Lists the store's directories again and adds the documents found
+        there that the manifest lacks, such as those another writer has
+        added since it was read. Returns how many were added.
+        """
+        if self._dedupe:
+            content, logged = self._read_content()
+            with self._content_lock:
+                content.update(self._content)
+                self._content = content
+                self._blobs = set(content.values())
+        found = self._scan_manifest(workers) - self._manifest
+        dirname = os.path.dirname(self.__dbfilename)
+        for rel in sorted(found):
+            try:
+                self._add_to_manifest(os.path.join(dirname, rel))
+            except IOError:
+                #read only, it is in the manifest in memory all the same
+                pass
+        return len(found)
+
+    def _relative(self, fname):
+        """ fname relative to the store's directory """
+        dirname = os.path.dirname(self.__dbfilename)
+        if dirname and fname.startswith(dirname + os.sep):
+            return fname[len(dirname)+1:]
+        return os.path.relpath(fname, dirname)
+
+    def _scan_manifest(self, workers=8):
+        """
+        Finds which of the documents this store can hold are on disk.
+        Each directory is listed once, in parallel, instead of each file
+        being probed.
+        """
+        if self._dedupe:
+            return set(self._content)
+        dirname = os.path.dirname(self.__dbfilename)
+        candidates = {}
+        for desc, fname, doctype in self.get_index().select({}):
+            rel = self._relative(fname)
+            candidates.setdefault(os.path.dirname(rel), []).append(rel)
+        subdirs = candidates.keys()
+
+        def listdir(subdir):
+            try:
+                return set(os.listdir(os.path.join(dirname, subdir)))
+            except OSError:
+                return set()
+
+        pool = ThreadPool(workers)
+        try:
+            listings = pool.map(listdir, subdirs)
+        finally:
+            pool.close()
+        manifest = set()
+        for subdir, names in zip(subdirs, listings):
+            for rel in candidates[subdir]:
+                if os.path.basename(rel) in names:
+                    manifest.add(rel)
+        return manifest
 
     @property
     def filename_pattern(self):
@@ -555,6 +1582,7 @@ class FileStore(Store):
     @filename_pattern.setter
     def filename_pattern(self, val):
         self.__filename_pattern = val
+        self._indices = {}
 
         #choose default data type in the store based on file extension
         self._default_type = 'RGB'
@@ -587,6 +1615,8 @@ class FileStore(Store):
                 ext = ".exr"
             else:
                 ext = ".im"
+        if doctype == "VALUE":
+            ext = ".npz"
 
         fullpath = os.path.join(dirname, base+ext)
         return fullpath
@@ -595,85 +1625,903 @@ class FileStore(Store):
         super(FileStore, self).insert(document)
 
         fname = self._get_filename(document.descriptor)
+        if self.decode_cache is not None:
+            self.decode_cache.discard(fname)
+
+        if document.data is None:
+            self._make_dirs(fname)
+            return
+
+        doctype = self.determine_type(document.descriptor)
+        data = document.data
+        if self._writer is not None and isinstance(data, np.ndarray):
+            #the caller is free to reuse its buffer once we return
+            data = data.copy()
+        self._store_data(fname, doctype, data)
+        self._store_levels(fname, doctype, data, self._pyramid_levels)
+
+    def _store_data(self, fname, doctype, data):
+        """ writes data out as the document at fname """
+        target = fname
+        if self._dedupe:
+            target = self._add_content(fname, doctype, data)
+            if target is None:
+                #same content is already stored
+                self._add_to_manifest(fname)
+                return
+        if self._writer is None:
+            self._write_document(fname, target, doctype, data)
+        else:
+            self._writer.submit(self._write_document,
+                                fname, target, doctype, data)
+
+    def _write_document(self, fname, target, doctype, data):
+        """ writes data to target, then lists fname in the manifest """
+        self._write_data(target, doctype, data)
+        #only once it is there, a failed write must not claim otherwise
+        self._add_to_manifest(fname)
+
+    def _store_levels(self, fname, doctype, data, levels):
+        """ writes levels 1 to levels of the pyramid for fname's data """
+        if not isinstance(data, np.ndarray):
+            return
+        if self.decode_cache is not None:
+            for level in range(1, levels+1):
+                self.decode_cache.discard(self._level_filename(fname, level))
+        for level in range(1, levels+1):
+            data = np.ascontiguousarray(downsample(data, doctype))
+            self._store_data(self._level_filename(fname, level), doctype, data)
+
+    def _level_filename(self, fname, level):
+        """ where the document at fname is kept at a pyramid level """
+        dirname = os.path.dirname(self.__dbfilename)
+        return os.path.join(dirname, "pyramid", str(level),
+                            self._relative(fname))
+
+    def build_pyramid(self, levels):
+        """
+        Writes pyramid levels 1 to levels for every document already in
+        the store, and has later inserts write them as well.
+        """
+        for desc, fname, doctype in self.get_index().select({}):
+            if not self._written(fname):
+                continue
+            data = self._read(self._resolve(fname), doctype)
+            self._store_levels(fname, doctype, data, levels)
+        self._pyramid_levels = max(levels, self._pyramid_levels)
+        self.add_metadata({"pyramid_levels" : self._pyramid_levels})
+        self.flush()
 
+    def _add_content(self, fname, doctype, data):
+        """
+        Points the document at fname to the blob holding data. Returns the
+        blob's filename if it still has to be written, None otherwise.
+        """
+        digest = hashlib.sha1(doctype)
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data)
+            digest.update(str(data.shape) + data.dtype.str)
+        digest.update(data)
+        dirname = os.path.dirname(self.__dbfilename)
+        blob = "blobs/" + digest.hexdigest() + os.path.splitext(fname)[1]
+        rel = self._relative(fname)
+        with self._content_lock:
+            if self._content.get(rel) != blob:
+                self._content[rel] = blob
+                if self._content_log is None:
+                    self._content_log = open(
+                        self._content_filename() + ".log", mode="ab")
+                self._content_log.write(json.dumps([rel, blob]) + "\n")
+                self._content_log.flush()
+                self._content_logged = self._content_logged + 1
+            if blob in self._blobs:
+                return None
+            self._blobs.add(blob)
+        return os.path.join(dirname, blob)
+
+    def _resolve(self, fname):
+        """ the file that actually holds the document at fname """
+        if not self._dedupe:
+            return fname
+        dirname = os.path.dirname(self.__dbfilename)
+        blob = self._content.get(self._relative(fname))
+        if blob is None:
+            return fname
+        return os.path.join(dirname, blob)
+
+    def set_background_writers(self, workers=2, queue_size=8):
+        """
+        Makes insert() hand documents to a pool of writer threads and
+        return right away instead of encoding and writing them itself.
+        At most queue_size documents wait in memory, beyond that insert()
+        blocks. Call flush() to wait for the writes to land, errors that
+        happen in the background surface there or at the next insert().
+        workers=0 flushes and goes back to writing synchronously.
+        """
+        if self._writer is not None:
+            writer = self._writer
+            self._writer = None
+            writer.close()
+        if workers > 0:
+            self._writer = BackgroundWriter(workers, queue_size)
+
+    def flush(self):
+        super(FileStore, self).flush()
+        if self._writer is not None:
+            self._writer.flush()
+        self.save()
+        self._fold_logs(True)
+        self._journal.fold()
+
+    @staticmethod
+    def _make_dirs(fname):
         dirname = os.path.dirname(fname)
         if not os.path.exists(dirname):
-            os.makedirs(dirname)
-
-        if not document.data == None:
-            doctype = self.determine_type(document.descriptor)
-            if doctype == 'RGB':
-                imageslice = document.data
-                pimg = PIL.Image.fromarray(imageslice)
-                pimg.save(fname)
-            elif doctype == 'LUMINANCE':
-                imageslice = document.data
-                pimg = PIL.Image.fromarray(imageslice)
-                pimg.save(fname)
-            elif doctype == 'Z':
-                imageslice = document.data
-                if exrEnabled:
-                    exr.save_depth(imageslice, fname)
-                else:
-                    pimg = PIL.Image.fromarray(imageslice)
-                    #TODO: avoid letting ImImagePlugin.py insert the Name: filename in line two
-                    #      why? because ImImagePlugin.py has a 100 character limit when it reads back
-                    pimg.save(fname)
-                pimg.save(fname) #beside PIL.im, is there a standard for depth images?
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                #another writer may have just made it
+                if not os.path.isdir(dirname):
+                    raise
+
+    def _write_data(self, fname, doctype, data):
+        """ encodes data as doctype and writes it to fname """
+        self._make_dirs(fname)
+        if doctype == 'RGB':
+            pimg = PIL.Image.fromarray(data)
+            pimg.save(fname)
+        elif doctype == 'LUMINANCE':
+            pimg = PIL.Image.fromarray(data)
+            pimg.save(fname)
+        elif doctype == 'Z':
+            if exrEnabled:
+                exr.save_depth(data, fname)
             else:
-                with open(fname, mode='w') as file:
-                    file.write(document.data)
+                pimg = PIL.Image.fromarray(data)
+                #TODO: avoid letting ImImagePlugin.py insert the Name: filename in line two
+                #      why? because ImImagePlugin.py has a 100 character limit when it reads back
+                pimg.save(fname) #beside PIL.im, is there a standard for depth images?
+        elif doctype == 'VALUE':
+            with open(fname, mode='wb') as file:
+                np.savez_compressed(file, value=np.asarray(data, np.float32))
+        else:
+            with open(fname, mode='w') as file:
+                file.write(data)
+        if self.decode_cache is not None:
+            #a reader may have cached the old contents while this was queued
+            self.decode_cache.discard(fname)
 
-    def _load_data(self, doc_file, descriptor):
+    def _load_data(self, doc_file, descriptor, doctype=None, level=0):
         #print "LOAD", doc_file
-        doctype = self.determine_type(descriptor)
+        if doctype is None:
+            doctype = self.determine_type(descriptor)
+        for stored in range(min(level, self._pyramid_levels), 0, -1):
+            level_file = self._level_filename(doc_file, stored)
+            if self._written(level_file):
+                #closest level on disk, make up the rest on the fly
+                level_file = self._resolve(level_file)
+                doc = Document(descriptor, loader=lambda: downsample(
+                    self._read(level_file, doctype), doctype, level - stored))
+                doc.attributes = None
+                return doc
+        if not self._written(doc_file):
+            #never written, no need to look
+            doc = Document(descriptor, None)
+            doc.attributes = None
+            return doc
+        doc_file = self._resolve(doc_file)
+        doc = Document(descriptor, loader=lambda: downsample(
+            self._read(doc_file, doctype), doctype, level))
+        doc.attributes = None
+        return doc
+
+    def _read(self, doc_file, doctype):
+        """ the data in doc_file, from the decode cache if it is there """
+        cache = self.decode_cache
+        if cache is not None:
+            data = cache.get((doc_file, doctype))
+            if data is not None:
+                return data
+        data = self._decode(doc_file, doctype)
+        if cache is not None and data is not None:
+            data = cache.put((doc_file, doctype), data)
+        return data
+
+    def _decode(self, doc_file, doctype):
+        """ reads doc_file back as doctype, None if it can not be read """
         try:
-            if doctype == 'RGB':
-                im = PIL.Image.open(doc_file)
-                data = np.array(im, np.uint8).reshape(im.size[1], im.size[0], 3)
-            elif doctype == 'LUMINANCE':
-                im = PIL.Image.open(doc_file)
-                data = np.array(im, np.uint8).reshape(im.size[1], im.size[0], 3)
+            if doctype in ['RGB', 'LUMINANCE']:
+                return self._image_to_array(PIL.Image.open(doc_file), doctype)
             elif doctype == 'Z':
                 if exrEnabled:
-                    data = exr.load_depth(doc_file)
-                else:
-                    im = PIL.Image.open(doc_file)
-                    data = np.array(im, np.float32).reshape(im.size[1], im.size[0])
+                    return exr.load_depth(doc_file)
+                return self._image_to_array(PIL.Image.open(doc_file), doctype)
+            elif doctype == 'VALUE':
+                npz = np.load(doc_file)
+                try:
+                    return npz['value']
+                finally:
+                    npz.close()
             else:
                 with open(doc_file, "r") as file:
-                    data = file.read()
+                    return file.read()
         except IOError:
-            data = None
-        doc = Document(descriptor, data)
-        doc.attributes = None
-        return doc
+            return None
 
-    def find(self, q=None, forGUI=False):
+    @staticmethod
+    def _image_to_array(im, doctype):
+        if doctype == 'Z':
+            return np.array(im, np.float32).reshape(im.size[1], im.size[0])
+        return np.array(im, np.uint8).reshape(im.size[1], im.size[0], 3)
+
+    def _select(self, q, forGUI=False):
+        """
+        Yield (descriptor, filename, type) for every document matching q.
+        """
+        if self.has_predicates(q):
+            masks = self.compile_query(q)
+            if masks is None:
+                return
+            accepted = {}
+            for name, mask in masks.iteritems():
+                vals = self.get_parameter(name)['values']
+                accepted[name] = [vals[i] for i in np.flatnonzero(mask)]
+            for entry in self.get_index(forGUI).select_accepted(accepted):
+                yield entry
+            return
+
+        for name, value in q.iteritems():
+            if (not name in self.parameter_list or
+                not value in self.get_parameter(name)['values']):
+                #not something the index knows about, take the slow path
+                for possible_desc in self.iterate(fixedargs=q, forGUI=forGUI):
+                    yield (possible_desc,
+                           self._get_filename(possible_desc),
+                           self.determine_type(possible_desc))
+                return
+
+        for entry in self.get_index(forGUI).select(q):
+            yield entry
+
+    def find(self, q=None, forGUI=False, level=0):
+        """
+        See Store.find. level=k returns images at 1/2**k resolution, from
+        the pyramid if it has been written or reduced on the fly if not.
+        """
         q = q if q else dict()
         target_desc = q
 
-        for possible_desc in self.iterate(fixedargs=target_desc, forGUI=forGUI):
+        for possible_desc, filename, doctype in \
+                self._select(target_desc, forGUI):
             if possible_desc == {}:
                 yield None
-            filename = self._get_filename(possible_desc)
             #print filename
-            yield self._load_data(filename, possible_desc)
+            yield self._load_data(filename, possible_desc, doctype, level)
+
+    def count(self, q=None):
+        """ number of documents matching q that have been written """
+        q = q if q else dict()
+        n = 0
+        for desc, filename, doctype in self._select(q):
+            if self._written(filename):
+                n = n + 1
+        return n
+
+    def find_many(self, queries=None, fields=None, workers=4):
+        entries = []
+        for q in self._as_queries(queries):
+            for entry in self._select(q):
+                if fields is not None and not entry[2] in fields:
+                    continue
+                if not self._written(entry[1]):
+                    #never produced, count() leaves it out as well
+                    continue
+                entries.append(entry)
+
+        def load(i):
+            desc, filename, doctype = entries[i]
+            return self._load_data(filename, desc, doctype).data
+
+        descs = [entry[0] for entry in entries]
+        return _stack_documents(descs, load, workers), descs
+
+
+def _encode_payload(doctype, data, ext='.png'):
+    """
+    Turns a document's data into bytes for stores that keep documents in
+    a container rather than in files of their own. Depth and values are
+    kept raw, images are encoded in the format ext names.
+    Returns (encoding, payload, shape, dtype).
+    """
+    if doctype in ['Z', 'VALUE']:
+        data = np.ascontiguousarray(data)
+        return 'array', data.tostring(), list(data.shape), data.dtype.str
+    if doctype in ['RGB', 'LUMINANCE']:
+        PIL.Image.init()
+        buf = io.BytesIO()
+        PIL.Image.fromarray(data).save(buf, PIL.Image.EXTENSION[ext.lower()])
+        return 'image', buf.getvalue(), None, None
+    return 'bytes', data, None, None
+
+def _decode_payload(buf, offset, length, doctype, encoding, shape, dtype):
+    """
+    Reverses _encode_payload for the length bytes at offset in buf.
+    Raw arrays are returned as views into buf.
+    """
+    if encoding == 'array':
+        dtype = np.dtype(str(dtype))
+        data = np.frombuffer(buf, dtype, length // dtype.itemsize, offset)
+        return data.reshape(shape)
+    payload = buf[offset:offset+length]
+    if encoding == 'image':
+        return FileStore._image_to_array(PIL.Image.open(io.BytesIO(payload)),
+                                         doctype)
+    return payload
+
+class PackedFileStore(FileStore):
+    """
+    A FileStore whose documents all live in one blob file, cinema.pack,
+    instead of a tree of small files. The offset index, cinema.pack.json,
+    maps the relative path FileStore would have written a document to
+    (which encodes its descriptor) to where its bytes are in the blob.
+    Reads go through a read-only memory map of the blob, so fetching a
+    document does not open any file. Depth arrays are stored raw and come
+    back as views into the map, as do float value fields. Images keep their
+    encoded form.
+
+    Documents are only ever appended, inserting one again leaves its old
+    bytes behind as garbage. Each index record is appended to
+    cinema.pack.json.log as its document is written, so what was packed
+    survives a writer that never gets to save(). The index file is
+    rewritten from it the same way content.json is. Use pack_store() to
+    convert a FileStore.
+    """
+
+    def __init__(self, dbfilename=None):
+        super(PackedFileStore, self).__init__(dbfilename)
+        dbfilename = dbfilename if dbfilename \
+                else os.path.join(os.getcwd(), "info.json")
+        self._pack_dir = os.path.dirname(dbfilename)
+        self._pack_lock = threading.Lock()
+        self._pack_index = {}
+        self._pack_file = None
+        self._pack_log = None
+        self._pack_logged = 0
+        self._pack_map = None
+        self.add_metadata({"store_type" : "PACKED"})
+
+    def _pack_path(self, suffix=""):
+        return os.path.join(self._pack_dir, "cinema.pack" + suffix)
+
+    def _pack_key(self, fname):
+        return self._relative(fname)
+
+    def load(self):
+        """loads an existing packed store"""
+        try:
+            with open(self._pack_path(".json"), mode="rb") as file:
+                self._pack_index = json.load(file)
+        except IOError:
+            #nothing was saved yet, the log has it all
+            self._pack_index = {}
+        logged = self._read_pack_log()
+        self._pack_index.update(logged)
+        self._pack_logged = len(logged)
+        self._pack_map = None
+        super(PackedFileStore, self).load()
+
+    def _read_pack_log(self):
+        """ the index records appended since the index was last saved """
+        records = {}
+        try:
+            with open(self._pack_path(".json.log"), mode="rb") as file:
+                for line in file:
+                    try:
+                        key, entry = json.loads(line)
+                    except ValueError:
+                        #a record cut short by an interrupted writer
+                        continue
+                    records[key] = entry
+        except IOError:
+            pass
+        return records
+
+    def _scan_manifest(self, workers=8):
+        #the offset index already says what is there
+        return set(self._pack_index)
+
+    def _written(self, fname):
+        #nothing is written outside of the pack
+        return self._pack_key(fname) in self._pack_index
+
+    def _fold_logs(self, force):
+        super(PackedFileStore, self)._fold_logs(force)
+        logged = self._pack_logged
+        if logged >= self.LOG_LIMIT or (force and (logged or
+                not os.path.exists(self._pack_path(".json")))):
+            self._write_pack_index()
+
+    def _write_pack_index(self):
+        """ writes cinema.pack.json and starts a new log after it """
+        with self._pack_lock:
+            if self._pack_file is not None:
+                self._pack_file.flush()
+            tmpname = self._pack_path(".json.tmp")
+            with open(tmpname, mode="wb") as file:
+                json.dump(self._pack_index, file)
+            os.rename(tmpname, self._pack_path(".json"))
+            #the saved index holds every record logged so far
+            if self._pack_log is not None:
+                self._pack_log.close()
+            self._pack_log = open(self._pack_path(".json.log"), mode="wb")
+            self._pack_logged = 0
+
+    @staticmethod
+    def _make_dirs(fname):
+        #nothing is written outside of the pack
+        pass
+
+    def _write_data(self, fname, doctype, data):
+        """ encodes data as doctype and appends it to the pack """
+        encoding, payload, shape, dtype = \
+            _encode_payload(doctype, data, os.path.splitext(fname)[1])
+        self._append(self._pack_key(fname), payload, encoding, shape, dtype)
+        if self.decode_cache is not None:
+            self.decode_cache.discard(fname)
+
+    def _append(self, key, payload, encoding, shape=None, dtype=None):
+        """ adds payload to the end of the pack and indexes it as key """
+        with self._pack_lock:
+            if self._pack_file is None:
+                self._pack_file = open(self._pack_path(), mode="ab")
+            self._pack_file.seek(0, os.SEEK_END)
+            offset = self._pack_file.tell()
+            self._pack_file.write(payload)
+            self._pack_file.flush()
+            entry = [offset, len(payload), encoding,
+                     list(shape) if shape else None, dtype]
+            self._pack_index[key] = entry
+            if self._pack_log is None:
+                self._pack_log = open(self._pack_path(".json.log"), mode="ab")
+            self._pack_log.write(json.dumps([key, entry]) + "\n")
+            self._pack_log.flush()
+            self._pack_logged = self._pack_logged + 1
+
+    def _get_map(self, end):
+        """ a map of the pack that reaches at least up to byte end """
+        with self._pack_lock:
+            pmap = self._pack_map
+            if pmap is None or len(pmap) < end:
+                #earlier maps stay alive for as long as arrays view them
+                with open(self._pack_path(), mode="rb") as file:
+                    pmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._pack_map = pmap
+            return pmap
+
+    def _decode(self, doc_file, doctype):
+        entry = self._pack_index.get(self._pack_key(doc_file))
+        if entry is None:
+            return None
+        offset, length, encoding, shape, dtype = entry
+        pmap = self._get_map(offset + length)
+        return _decode_payload(pmap, offset, length,
+                               doctype, encoding, shape, dtype)
+
+def pack_store(source, dbfilename):
+    """
+    Copies every document of the FileStore source into a new
+    PackedFileStore at dbfilename and returns the new store. Images are
+    copied without being decoded again.
+    """
+    dest = PackedFileStore(dbfilename)
+    dest._set_parameter_list(copy.deepcopy(source.parameter_list))
+    dest._set_parameter_associations(
+        copy.deepcopy(source.parameter_associations))
+    dest._set_view_associations(copy.deepcopy(source.view_associations))
+    metadata = copy.deepcopy(source.metadata) or {}
+    #the pack holds every document once per descriptor
+    metadata.pop("dedupe", None)
+    metadata.pop("dedupe_ratio", None)
+    dest.add_metadata(metadata)
+    dest.add_metadata({"store_type" : "PACKED"})
+    dest.filename_pattern = source.filename_pattern
+    dest.create()
+
+    for desc in source.iterate():
+        fname = source._resolve(source._get_filename(desc))
+        if not os.path.exists(fname):
+            continue
+        doctype = source.determine_type(desc)
+        key = dest._pack_key(dest._get_filename(desc))
+        if doctype in ['Z', 'VALUE']:
+            #depth and values are kept raw so that reading them back is free
+            data = source._decode(fname, doctype)
+            encoding, payload, shape, dtype = _encode_payload(doctype, data)
+            dest._append(key, payload, encoding, shape, dtype)
+        else:
+            with open(fname, mode="rb") as file:
+                payload = file.read()
+            encoding = 'bytes' if doctype == 'TXT' else 'image'
+            dest._append(key, payload, encoding)
+        dest._add_to_manifest(os.path.join(dest._pack_dir, key))
+    dest.flush()
+    return dest
+
+class SQLiteStore(Store):
+    """
+    Implementation of a store that records every document in an SQLite
+    database, cinema.sqlite, next to info.json. The documents table has a
+    column per parameter, each with its own index, so find() with exact
+    values, ranges, sets and wildcards is answered by indexed SQL rather
+    than by enumerating the parameter space. Document data is kept in the
+    table as blobs or, with external=True, in files under data/ that the
+    table refers to.
+
+    All writes go through one connection and are committed in batches,
+    readers each have their own connection. Reading through the store
+    commits what is pending first, so find() and count() see every
+    insert made before them. Call flush() to make inserts visible to
+    other processes. An insert that fails rolls back every insert since
+    the last commit.
+    """
+
+    COMMIT_EVERY = 1000
+
+    def __init__(self, dbfilename=None, external=False):
+        super(SQLiteStore, self).__init__()
+        self.__dbfilename = dbfilename if dbfilename \
+                else os.path.join(os.getcwd(), "info.json")
+        self._external = external
+        self._journal = MetadataJournal(self.__dbfilename)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._write_connection = None
+        self._pending = 0
+        self._columns = None
+        #set to None to decode on every find, or to a private DecodeCache
+        self.decode_cache = decode_cache
+        self.add_metadata({"store_type" : "SQLITE"})
+        if external:
+            self.add_metadata({"external_data" : True})
+
+    def _parameters_changed(self):
+        super(SQLiteStore, self)._parameters_changed()
+        self._columns = None
+
+    def _path(self, name):
+        return os.path.join(os.path.dirname(self.__dbfilename), name)
+
+    def _connect(self):
+        return sqlite3.connect(self._path("cinema.sqlite"), timeout=60,
+                               check_same_thread=False)
+
+    def _connection(self):
+        """ this thread's connection to the database, for reading """
+        if self._pending:
+            #a connection of its own sees only what has been committed
+            self._commit()
+        con = getattr(self._local, 'connection', None)
+        if con is None:
+            con = self._connect()
+            self._local.connection = con
+        return con
+
+    def _writer(self):
+        """ the connection every write goes through, hold _write_lock """
+        if self._write_connection is None:
+            self._write_connection = self._connect()
+        return self._write_connection
+
+    def _rollback(self):
+        """ drops what was written since the last commit, hold _write_lock """
+        self._pending = 0
+        try:
+            self._write_connection.rollback()
+        except sqlite3.Error:
+            #the error we are cleaning up after is the one to report
+            pass
+
+    @staticmethod
+    def _quote(name):
+        return '"' + name.replace('"', '""') + '"'
+
+    def _ensure_schema(self):
+        """ adds a column and an index for any parameter the table lacks """
+        if self._columns is not None:
+            return
+        with self._write_lock:
+            con = self._writer()
+            con.execute("CREATE TABLE IF NOT EXISTS documents ("
+                        "_key TEXT PRIMARY KEY, _doctype TEXT, "
+                        "_encoding TEXT, _shape TEXT, _dtype TEXT, "
+                        "_payload BLOB, _path TEXT)")
+            columns = set(row[1] for row in
+                          con.execute("PRAGMA table_info(documents)"))
+            for name in sorted(self.parameter_list.keys()):
+                if not name in columns:
+                    con.execute("ALTER TABLE documents ADD COLUMN %s" %
+                                self._quote(name))
+                    con.execute("CREATE INDEX IF NOT EXISTS %s ON "
+                                "documents (%s)" %
+                                (self._quote("by " + name), self._quote(name)))
+                    columns.add(name)
+            con.commit()
+        self._columns = columns
+
+    def create(self):
+        """creates a new sqlite store"""
+        super(SQLiteStore, self).create()
+        self.save()
+        #readers are not blocked by a writer
+        with self._write_lock:
+            self._writer().execute("PRAGMA journal_mode=WAL")
+        self._ensure_schema()
+
+    def load(self):
+        """loads an existing sqlite store"""
+        super(SQLiteStore, self).load()
+        info_json = self._journal.read()
+        self._set_parameter_list(info_json['arguments'])
+        self.metadata = info_json['metadata']
+        a = {}
+        if 'associations' in info_json:
+            a = info_json['associations']
+        self._set_parameter_associations(a)
+        va = {}
+        if 'view_associations' in info_json:
+            va = info_json['view_associations']
+        if va == {}:
+            va = copy.deepcopy(a)
+        self._set_view_associations(va)
+        self._external = bool(self.metadata.get('external_data'))
+        self._ensure_schema()
+
+    def save(self):
+        """ writes out a modified store """
+        info_json = dict(
+                arguments = self.parameter_list,
+                metadata = self.metadata,
+                associations = self.parameter_associations,
+                view_associations = self.view_associations
+                )
+        dirname = os.path.dirname(self.__dbfilename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._journal.write(info_json)
+        self._commit()
+
+    def flush(self):
+        super(SQLiteStore, self).flush()
+        self._commit()
+        self._journal.fold()
+
+    def _commit(self):
+        with self._write_lock:
+            if self._write_connection is not None:
+                try:
+                    self._write_connection.commit()
+                except Exception:
+                    self._rollback()
+                    raise
+            self._pending = 0
+
+    def insert(self, document):
+        super(SQLiteStore, self).insert(document)
+        if document.data is None:
+            return
+        self._ensure_schema()
+        desc = document.descriptor
+        for name in desc:
+            if not name in self._columns:
+                raise RuntimeError, "Unknown parameter %s" % name
+        doctype = self.determine_type(desc)
+        key = json.dumps(desc, sort_keys=True)
+        encoding, payload, shape, dtype = \
+            _encode_payload(doctype, document.data)
+        path = None
+        if self._external:
+            path = "data/" + hashlib.sha1(key).hexdigest()
+            fname = self._path(path)
+            FileStore._make_dirs(fname)
+            with open(fname, mode="wb") as file:
+                file.write(payload)
+            payload = None
+        else:
+            payload = sqlite3.Binary(payload)
+
+        names = sorted(desc.keys())
+        sql = "INSERT OR REPLACE INTO documents " \
+              "(_key, _doctype, _encoding, _shape, _dtype, _payload, _path%s) " \
+              "VALUES (?, ?, ?, ?, ?, ?, ?%s)" % \
+              ("".join(", " + self._quote(n) for n in names),
+               ", ?" * len(names))
+        row = [key, doctype, encoding, json.dumps(shape), dtype, payload, path]
+        row.extend(desc[n] for n in names)
+        with self._write_lock:
+            con = self._writer()
+            try:
+                con.execute(sql, row)
+                self._pending = self._pending + 1
+                if self._pending >= self.COMMIT_EVERY:
+                    con.commit()
+                    self._pending = 0
+            except Exception:
+                #do not leave the database locked for everyone else
+                self._rollback()
+                raise
+        if self.decode_cache is not None:
+            self.decode_cache.discard(self._cache_name(key))
+
+    def _where(self, q):
+        """
+        Translate query q into an SQL condition and its arguments, or
+        (None, None) if nothing can match.
+        """
+        clauses = []
+        args = []
+        for name in sorted(q.keys()):
+            if not name in self.parameter_list:
+                return None, None
+            pred = q[name]
+            column = self._quote(name)
+            if isinstance(pred, (set, frozenset, list, tuple)):
+                pred = OneOf(pred)
+            if isinstance(pred, Range):
+                clauses.append(column + " IS NOT NULL")
+                if pred.low is not None:
+                    clauses.append(column + " >= ?")
+                    args.append(pred.low)
+                if pred.high is not None:
+                    clauses.append(column + " <= ?")
+                    args.append(pred.high)
+                continue
+            if isinstance(pred, _Any):
+                clauses.append(column + " IS NOT NULL")
+                continue
+            if isinstance(pred, Predicate) and not isinstance(pred, OneOf):
+                #evaluate it against the parameter's values instead
+                mask = self.compile_query({name: pred})[name]
+                vals = self.get_parameter(name)['values']
+                pred = OneOf([vals[i] for i in np.flatnonzero(mask)])
+            if isinstance(pred, OneOf):
+                if len(pred.values) == 0:
+                    return None, None
+                clauses.append("%s IN (%s)" % (column, ", ".join(
+                    ["?"] * len(pred.values))))
+                args.extend(pred.values)
+            else:
+                clauses.append(column + " = ?")
+                args.append(pred)
+        where = ""
+        if clauses:
+            where = " WHERE " + " AND ".join(clauses)
+        return where, args
+
+    def _select(self, q):
+        """ Yield (key, type) of every document matching q, in insert order """
+        self._ensure_schema()
+        where, args = self._where(q)
+        if where is None:
+            return
+        cursor = self._connection().execute(
+            "SELECT _key, _doctype FROM documents" + where + " ORDER BY rowid",
+            args)
+        for row in cursor:
+            yield row
+
+    def _cache_name(self, key):
+        return self._path("cinema.sqlite") + "#" + key
+
+    def _read(self, key, doctype):
+        """ the data of the document stored under key """
+        cache = self.decode_cache
+        if cache is not None:
+            data = cache.get((self._cache_name(key), doctype))
+            if data is not None:
+                return data
+        row = self._connection().execute(
+            "SELECT _encoding, _shape, _dtype, _payload, _path "
+            "FROM documents WHERE _key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        encoding, shape, dtype, payload, path = row
+        if path is not None:
+            try:
+                with open(self._path(path), mode="rb") as file:
+                    payload = file.read()
+            except IOError:
+                return None
+        data = _decode_payload(payload, 0, len(payload),
+                               doctype, encoding, json.loads(shape), dtype)
+        if cache is not None and data is not None:
+            data = cache.put((self._cache_name(key), doctype), data)
+        return data
+
+    def _document(self, key, doctype, level):
+        doc = Document(json.loads(key), loader=lambda: downsample(
+            self._read(key, doctype), doctype, level))
+        doc.attributes = None
+        return doc
 
+    def find(self, q=None, level=0):
+        """
+        See Store.find. Parameters may be given exact values, Range, OneOf
+        (or sets and lists) and ANY, each of which is answered from the
+        parameter's index. level=k reduces the images on the fly.
+        """
+        q = q if q else dict()
+        for key, doctype in list(self._select(q)):
+            yield self._document(key, doctype, level)
+
+    def count(self, q=None):
+        q = q if q else dict()
+        self._ensure_schema()
+        where, args = self._where(q)
+        if where is None:
+            return 0
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM documents" + where, args).fetchone()[0]
+
+    def find_many(self, queries=None, fields=None, workers=4):
+        entries = []
+        for q in self._as_queries(queries):
+            for key, doctype in list(self._select(q)):
+                if fields is None or doctype in fields:
+                    entries.append((key, doctype))
+
+        def load(i):
+            return self._read(entries[i][0], entries[i][1])
+
+        descs = [json.loads(entry[0]) for entry in entries]
+        return _stack_documents(descs, load, workers), descs
 
 class SingleFileStore(Store):
-    """Implementation of a store based on a single volume file (image stack)."""
+    """
+    Implementation of a store based on a single volume file (image stack).
 
-    def __init__(self, dbfilename=None):
+    The stack is kept either as a VTK image data file (cinema.vti), which
+    is read and written as a whole, or as a raw array (cinema.raw) that is
+    memory mapped, so slices are read and written in place. The raw file
+    starts with a RAW_HEADER_SIZE byte, space padded, JSON header giving
+    the shape and data type of the array that follows it.
+    """
+
+    VOLUME_FORMATS = ['vti', 'raw']
+    RAW_HEADER_SIZE = 4096
+
+    def __init__(self, dbfilename=None, volume_format='vti'):
         super(SingleFileStore, self).__init__()
         self.__dbfilename = dbfilename if dbfilename \
                 else os.path.join(os.getcwd(), "info.json")
+        if not volume_format in self.VOLUME_FORMATS:
+            raise RuntimeError, "Invalid volume format, must be one of %s" % \
+                str(self.VOLUME_FORMATS)
+        self._volume_format = volume_format
         self._volume = None
+        self._volume_writable = False
         self._needWrite = False
+        self._lattice = None
+        self._journal = MetadataJournal(self.__dbfilename)
         self.add_metadata({"store_type" : "SFS"})
+        if volume_format != 'vti':
+            self.add_metadata({"volume_format" : volume_format})
+
+    def _parameters_changed(self):
+        super(SingleFileStore, self)._parameters_changed()
+        self._lattice = None
+
+    def flush(self):
+        super(SingleFileStore, self).flush()
+        if (self._volume_format == 'raw' and self._volume is not None and
+            self._volume_writable):
+            self._volume.flush()
+        self._journal.fold()
 
     def __del__(self):
         if self._needWrite:
+            if self._volume_format == 'raw':
+                self._volume.flush()
+                return
             import vtk
             vw = vtk.vtkXMLImageDataWriter()
             vw.SetFileName(self._vol_file)
@@ -688,10 +2536,13 @@ class SingleFileStore(Store):
     def load(self):
         """loads an existing filestore"""
         super(SingleFileStore, self).load()
-        with open(self.__dbfilename, mode="rb") as file:
-            info_json = json.load(file)
-            self._set_parameter_list(info_json['arguments'])
-            self.metadata = info_json['metadata']
+        info_json = self._journal.read()
+        self._set_parameter_list(info_json['arguments'])
+        self.metadata = info_json['metadata']
+        if self.metadata and 'volume_format' in self.metadata:
+            self._volume_format = self.metadata['volume_format']
+        else:
+            self._volume_format = 'vti'
 
     def save(self):
         """ writes out a modified file store """
@@ -702,8 +2553,7 @@ class SingleFileStore(Store):
         dirname = os.path.dirname(self.__dbfilename)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
-        with open(self.__dbfilename, mode="wb") as file:
-            json.dump(info_json, file)
+        self._journal.write(info_json)
 
     def _get_numslices(self):
         slices = 0
@@ -715,33 +2565,107 @@ class SingleFileStore(Store):
                 slices = slices * numvals
         return slices
 
+    def _get_lattice(self):
+        """
+        Slices are stored in the order of the product of the sorted
+        parameters, with the last parameter varying fastest. This returns
+        the sorted names, a name to axis map, the values along each axis,
+        a value to position map for each axis and the stride of each axis,
+        which together turn a descriptor into a slice index arithmetically.
+        """
+        if self._lattice is None:
+            names = sorted(self.parameter_list.keys())
+            axes = dict((name, axis) for axis, name in enumerate(names))
+            values = []
+            positions = []
+            for name in names:
+                vals = self.get_parameter(name)['values']
+                position = {}
+                for idx, val in enumerate(vals):
+                    position.setdefault(val, idx)
+                values.append(vals)
+                positions.append(position)
+            strides = [1] * len(names)
+            for axis in range(len(names) - 2, -1, -1):
+                strides[axis] = strides[axis + 1] * len(values[axis + 1])
+            self._lattice = (names, axes, values, positions, strides)
+        return self._lattice
+
     def compute_sliceindex(self, descriptor):
         #find position of descriptor within the set of slices
-        #TODO: algorithm is dumb, but consisent with find (which is also dumb)
-        args = []
-        values = []
-        ordered = sorted(self.parameter_list.keys())
-        for name in ordered:
-            vals = self.get_parameter(name)['values']
-            args.append(name)
-            values.append(vals)
+        #parameters missing from the descriptor count as their first value
+        names, axes, values, positions, strides = self._get_lattice()
         index = 0
-        for element in itertools.product(*values):
-            desc = dict(itertools.izip(args, element))
-            fail = False
-            for k,v in descriptor.items():
-                if desc[k] != v:
-                    fail = True
-            if not fail:
-                return index
-            index = index + 1
+        for k, v in descriptor.items():
+            axis = axes[k]
+            position = positions[axis].get(v)
+            if position is None:
+                return None
+            index = index + position * strides[axis]
+        return index
 
     def get_sliceindex(self, document):
         desc = self.get_complete_descriptor(document.descriptor)
         index = self.compute_sliceindex(desc)
         return index
 
+    def _map_raw(self, vol_file, writable):
+        """ memory maps an existing raw volume file """
+        with open(vol_file, mode="rb") as file:
+            header = json.loads(file.read(self.RAW_HEADER_SIZE))
+        volume = np.memmap(vol_file,
+                           dtype=np.dtype(str(header['dtype'])),
+                           mode="r+" if writable else "r",
+                           offset=header['offset'],
+                           shape=tuple(header['shape']))
+        self._volume = volume
+        self._volume_writable = writable
+        self._vol_file = vol_file
+        return volume
+
+    def _create_raw(self, vol_file, shape, dtype):
+        """ makes a raw volume file big enough for every slice and maps it """
+        shape = [self._get_numslices()] + list(shape)
+        dtype = np.dtype(dtype)
+        header = json.dumps(dict(
+                shape = shape,
+                dtype = dtype.str,
+                offset = self.RAW_HEADER_SIZE
+                ))
+        if len(header) >= self.RAW_HEADER_SIZE:
+            raise RuntimeError, "Raw volume header is too large"
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        with open(vol_file, mode="wb") as file:
+            file.write(header.ljust(self.RAW_HEADER_SIZE - 1) + "\n")
+            #leave the pixels to the file system, unwritten slices stay sparse
+            file.truncate(self.RAW_HEADER_SIZE + nbytes)
+        return self._map_raw(vol_file, True)
+
+    def _insertslice_raw(self, vol_file, index, document):
+        imageslice = np.asarray(document.data)
+        volume = self._volume
+        if volume is None or not self._volume_writable:
+            volume = None
+            self._volume = None
+            if os.path.exists(vol_file):
+                #add to what is already there, never recreate it because
+                #that would lose the slices it holds
+                volume = self._map_raw(vol_file, True)
+            else:
+                volume = self._create_raw(vol_file,
+                                          imageslice.shape, imageslice.dtype)
+        expected = (self._get_numslices(),) + imageslice.shape
+        if volume.shape != expected or volume.dtype != imageslice.dtype:
+            raise RuntimeError, \
+                "%s holds %s %s slices, can not insert a %s %s slice into it" % \
+                (vol_file, str(volume.shape), str(volume.dtype),
+                 str(expected), str(imageslice.dtype))
+        volume[index] = imageslice
+        self._needWrite = True
+
     def _insertslice(self, vol_file, index, document):
+        if self._volume_format == 'raw':
+            return self._insertslice_raw(vol_file, index, document)
         volume = self._volume
         width = document.data.shape[0]
         height = document.data.shape[1]
@@ -770,18 +2694,27 @@ class SingleFileStore(Store):
 
         index = self.get_sliceindex(document)
 
-        if not document.data == None:
+        if document.data is not None:
             dirname = os.path.dirname(self.__dbfilename)
             if not os.path.exists(dirname):
                 os.makedirs(dirname)
-            vol_file = os.path.join(dirname, "cinema.vti")
+            vol_file = os.path.join(dirname, "cinema." + self._volume_format)
             self._insertslice(vol_file, index, document)
 
-    def _load_slice(self, q, index, desc):
+    def _volume_array(self):
+        """
+        The whole image stack as one (slices, ...) numpy array that shares
+        memory with the volume, reading the volume in if need be.
+        """
+        dirname = os.path.dirname(self.__dbfilename)
+        if self._volume_format == 'raw':
+            volume = self._volume
+            if volume is None:
+                volume = self._map_raw(os.path.join(dirname, "cinema.raw"), False)
+            return np.asarray(volume)
 
         if not self._volume:
             import vtk
-            dirname = os.path.dirname(self.__dbfilename)
             vol_file = os.path.join(dirname, "cinema.vti")
             vr = vtk.vtkXMLImageDataReader()
             vr.SetFileName(vol_file)
@@ -793,41 +2726,100 @@ class SingleFileStore(Store):
             volume = self._volume
 
         ext = volume.GetExtent()
-        width = ext[1]-ext[0]
-        height = ext[3]-ext[2]
+        width = ext[1]-ext[0]+1
+        height = ext[3]-ext[2]+1
+        slices = ext[5]-ext[4]+1
 
         from vtk.numpy_interface import dataset_adapter as dsa
         image = dsa.WrapDataObject(volume)
-
-        oid = volume.ComputePointId([0, 0, index])
         nparray = image.PointData[0]
-        imageslice = np.reshape(nparray[oid:oid+width*height], (width,height,3))
+        return np.reshape(nparray, (slices,width,height,3))
 
-        doc = Document(desc, imageslice)
+    def _load_slice(self, q, index, desc, level=0):
+        #a view into the stack, for raw volumes pages are read as they are touched
+        step = 2 ** level
+        doc = Document(desc, loader=lambda:
+                       self._volume_array()[index, ::step, ::step])
         doc.attributes = None
         return doc
 
-    def find(self, q=None):
-        #TODO: algorithm is dumb, but consisent with compute_sliceindex (which is also dumb)
+    def _select(self, q):
+        """
+        Yield (slice index, descriptor) for every slice matching q in
+        increasing index order.
+        """
+        names, axes, values, positions, strides = self._get_lattice()
+
+        for k in q:
+            if not k in axes:
+                raise KeyError(k)
+
+        masks = {}
+        if self.has_predicates(q):
+            masks = self.compile_query(q)
+
+        #enumerate only the sub-lattice that matches the query
+        ranges = []
+        for axis, name in enumerate(names):
+            if name in masks:
+                ranges.append(np.flatnonzero(masks[name]).tolist())
+            elif name in q:
+                position = positions[axis].get(q[name])
+                if position is None:
+                    return
+                ranges.append([position])
+            else:
+                ranges.append(xrange(len(values[axis])))
+
+        for element in itertools.product(*ranges):
+            index = 0
+            desc = {}
+            for axis, position in enumerate(element):
+                index = index + position * strides[axis]
+                desc[names[axis]] = values[axis][position]
+            yield index, desc
+
+    def find(self, q=None, level=0):
+        """
+        See Store.find. level=k returns every 2**k-th pixel of each slice,
+        as a view into the stack.
+        """
         q = q if q else dict()
-        args = []
-        values = []
-        ordered = sorted(self.parameter_list.keys())
-        for name in ordered:
-            vals = self.get_parameter(name)['values']
-            args.append(name)
-            values.append(vals)
+        for index, desc in self._select(q):
+            yield self._load_slice(q, index, desc, level)
 
-        index = 0
-        for element in itertools.product(*values):
-            desc = dict(itertools.izip(args, element))
-            fail = False
-            for k,v in q.items():
-                if desc[k] != v:
-                    fail = True
-            if not fail:
-                yield self._load_slice(q, index, desc)
-            index = index + 1
+    def count(self, q=None):
+        """ number of slices matching q, every slice exists in the volume """
+        q = q if q else dict()
+        n = 0
+        for entry in self._select(q):
+            n = n + 1
+        return n
+
+    def find_many(self, queries=None, fields=None, workers=4):
+        indices = []
+        descs = []
+        for q in self._as_queries(queries):
+            for index, desc in self._select(q):
+                if fields is None or self.determine_type(desc) in fields:
+                    indices.append(index)
+                    descs.append(desc)
+        if len(indices) == 0:
+            return np.zeros((0, 0, 0, 0), np.uint8), descs
+
+        volume = self._volume_array()
+        steps = np.diff(indices)
+        if len(steps) == 0 or (steps[0] > 0 and (steps == steps[0]).all()):
+            #evenly spaced slices, hand back a view of the volume
+            step = steps[0] if len(steps) else 1
+            result = volume[indices[0]:indices[-1]+1:step]
+        else:
+            result = _stack_documents(descs,
+                                      lambda i: volume[indices[i]],
+                                      workers)
+        if result.ndim == 3:
+            result = result[:, :, :, np.newaxis]
+        return result, descs
 
 
 def make_parameter(name, values, **kwargs):
@@ -855,7 +2847,9 @@ def make_field(name, _values, **kwargs):
 
     values = _values.keys()
     img_types = _values.values()
-    valid_itypes = ['rgb','depth','value','luminance','normals']
+    #'value' fields are colors that encode a value in 24 bits,
+    #'floatvalue' fields hold the float32 values themselves
+    valid_itypes = ['rgb','depth','value','floatvalue','luminance','normals']
     for i in img_types:
         if i not in valid_itypes:
             raise RuntimeError, "Invalid typechoice, must be one of %s" % str(valid_itypes)
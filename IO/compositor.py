@@ -27,16 +27,53 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #==============================================================================
+import collections
+from multiprocessing.pool import ThreadPool
 import numpy as np
+from lookup_table import apply_table
 
 class Compositor(object):
-    def __init__(self):
-        """ Initialize """
+    def __init__(self, max_bytes=256*1024*1024, workers=4, tile_rows=256):
+        """
+        Initialize. The images of recently composited layers are kept, up
+        to max_bytes of them, so that a frame which changes only some
+        layers does not need the others loaded again.
+        Images taller than tile_rows are split into bands of that many
+        rows which are worked on by a pool of workers threads.
+        """
         self.lookup_table = None
+        self.max_bytes = max_bytes
+        self._layers = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._pool = None
+        self.set_tiling(workers, tile_rows)
+
+    def set_tiling(self, workers=4, tile_rows=256):
+        """
+        Sets the number of threads that render bands of tile_rows rows
+        concurrently. NumPy releases the GIL in the bulk of the work.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        self.workers = workers
+        self.tile_rows = tile_rows
+        if workers > 1:
+            self._pool = ThreadPool(workers)
+
+    def close(self):
+        """ Shut the pool's threads down, later frames are drawn in one piece. """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
 
     def set_lookup_table(self, lookup_table):
         """
-        Set the current lookup table used to recolor value images.
+        Set the current lookup table used to recolor value images, for
+        the layers that do not have one of their own.
         """
         self.lookup_table = lookup_table
 
@@ -53,49 +90,150 @@ class Compositor(object):
     def set_background_color(self, rgb):
         self._bgColor = rgb
 
+    def is_cached(self, layer):
+        """
+        True when the layer's images are kept from an earlier render, so
+        they do not need to be loaded again.
+        """
+        return layer.key() in self._layers
+
+    def clear(self):
+        """ forget every kept layer, e.g. when switching stores """
+        self._layers.clear()
+        self.nbytes = 0
+
+    def _layer(self, layer):
+        """
+        Returns the (encoded color, values, vrange, luminance, depth) of a
+        layer, see LayerSpec.getEncoded1, and keeps them for later renders.
+        """
+        key = layer.key()
+        entry = self._layers.pop(key, None)
+        if entry is not None:
+            #most recently used go last
+            self._layers[key] = entry
+            self.hits += 1
+            return entry[0:5]
+        self.misses += 1
+        entry = layer.getEncoded1() + (layer.getLuminance(), layer.getDepth())
+        nbytes = sum([image.nbytes for image in (entry[0], entry[3], entry[4])
+                      if image is not None])
+        self._layers[key] = entry + (nbytes,)
+        self.nbytes += nbytes
+        return entry
+
+    def _evict(self):
+        """ drop the least recently used layers until within budget """
+        while self.nbytes > self.max_bytes and self._layers:
+            self.nbytes -= self._layers.popitem(last=False)[1][5]
+
     def render(self, layers, hasLayer):
         """
         Takes an array of layers (LayerSpec) and composites them into an RGB image.
+
+        The nearest layer at each pixel is found first, with a running
+        minimum of depth and the index of the layer that holds it, so that
+        ties go to the earlier layer. Only then are colors made: each
+        layer's lookup table is applied to its encoded colors at just the
+        pixels that layer won, which are shaded by its luminance and
+        written directly into the output image. So every pixel is recolored
+        once, however many layers there are.
+
+        All of this is done one band of rows at a time, the bands in
+        parallel when there is more than one worker. Layers kept from
+        earlier renders need not have their images loaded.
         """
-        l0 = layers[0]
-        c0 = np.copy(l0.getColor1(self.lookup_table))
-        lum0 = l0.getLuminance()
-        if lum0 != None:
-            # modulate color of first layer by the luminance
-            lum0 = np.copy(lum0)
-            #c0[:,:,:] = c0[:,:,:] * (lum0[:,:,:]/255.0)
-            #c0 = self.colormap(c0)
-            lum0 = self.diffuse(lum0)
-            c0[:,:,:] = c0[:,:,:] * (lum0[:,:,:]/255.0)
-
-        d0 = None
-        if hasLayer:
-            d0 = np.copy(l0.getDepth())
-            for idx in range(1, len(layers)):
-                cnext = layers[idx].getColor1(self.lookup_table)
-                dnext = layers[idx].getDepth()
-                lnext = layers[idx].getLuminance()
-                # put the top pixels into place
-                indices = np.where(dnext < d0)
-                if lnext == None:
-                    # no luminance, direct insert
-                    c0[indices[0],indices[1],:] = cnext[indices[0],indices[1],:]
-                else:
-                    # modulate color by luminance then insert
-                    #cnext = self.colormap(cnext)
-                    lnext = self.diffuse(lnext)
-                    c0[indices[0], indices[1], :] = \
-                        cnext[indices[0], indices[1], :] * \
-                        (lnext[indices[0], indices[1], :] / 255.0)
-
-                d0[indices[0], indices[1]] = dnext[indices[0], indices[1]]
-
-        if d0 != None:
-            #set background pixels to gray to avoid colormap
-            #TODO: curious why necessary, we encode a NaN value on these pixels?
-            indices = np.where(d0>255)
-            c0[indices[0], indices[1], 0] = self._bgColor[0]
-            c0[indices[0], indices[1], 1] = self._bgColor[1]
-            c0[indices[0], indices[1], 2] = self._bgColor[2]
+        if not hasLayer:
+            #without depth only the first layer can be shown
+            layers = layers[:1]
+        images = [self._layer(layer) for layer in layers]
+        tables = [layer.lookupTable if layer.lookupTable is not None
+                  else self.lookup_table for layer in layers]
+
+        #color the first row to learn the shape and type of the result
+        encoded, values, vrange = images[0][0:3]
+        row = apply_table(tables[0], encoded[0:1], vrange, values)
+        height = encoded.shape[0]
+        c0 = np.empty((height,) + row.shape[1:], dtype=row.dtype)
+
+        def render_band(rows):
+            band = [(encoded[rows], values, vrange,
+                     lum[rows] if lum is not None else None,
+                     depth[rows] if depth is not None else None)
+                    for encoded, values, vrange, lum, depth in images]
+            self._composite(c0[rows], band, tables, hasLayer)
 
+        tile_rows = max(1, self.tile_rows)
+        bands = [slice(first, min(first + tile_rows, height))
+                 for first in range(0, height, tile_rows)]
+        if self._pool is None or len(bands) < 2:
+            for rows in bands:
+                render_band(rows)
+        else:
+            self._pool.map(render_band, bands)
+
+        self._evict()
         return c0
+
+    def _composite(self, c0, images, tables, hasLayer):
+        """
+        Composites one band, images holds the band of each layer's
+        (encoded color, values, vrange, luminance, depth), the result goes
+        into c0.
+        """
+        pixels = c0.reshape(-1, c0.shape[-1])
+        if not hasLayer:
+            self._shade(pixels, images[0], tables[0], None)
+            return
+
+        d0 = np.array(images[0][4], copy=True)
+        flat_d0 = d0.reshape(-1)
+        winner = np.zeros(d0.size, dtype=np.uint8 if len(images) <= 256 else np.intp)
+        mask = np.empty(d0.shape, dtype=np.bool_)
+        for idx in range(1, len(images)):
+            # put the top pixels into place
+            dnext = images[idx][4]
+            np.less(dnext, d0, out=mask)
+            closer = np.flatnonzero(mask)
+            flat_d0[closer] = np.take(dnext, closer)
+            winner[closer] = idx
+
+        if len(images) == 1:
+            self._shade(pixels, images[0], tables[0], None)
+        else:
+            for idx in range(0, len(images)):
+                np.equal(winner, idx, out=mask.reshape(-1))
+                self._shade(pixels, images[idx], tables[idx],
+                            np.flatnonzero(mask))
+
+        #set background pixels to gray to avoid colormap
+        #TODO: curious why necessary, we encode a NaN value on these pixels?
+        np.greater(d0, 255, out=mask)
+        pixels[np.flatnonzero(mask)] = self._bgColor[0:3]
+
+    @staticmethod
+    def _shade(pixels, images, table, where):
+        """
+        Colors a layer's encoded colors with table, modulates them by the
+        diffuse channel of its luminance when there is one, and writes
+        them into pixels (the output as a row per pixel) at the flat pixel
+        indices in where, or everywhere when where is None.
+        """
+        encoded, values, vrange, lum = images[0:4]
+        if where is None:
+            color = apply_table(table, encoded, vrange, values)
+            if lum is None:
+                pixels[...] = color.reshape(pixels.shape)
+            else:
+                # modulate color by luminance then insert
+                pixels[...] = (color * (lum[:,:,1:2] / 255.0)).reshape(pixels.shape)
+            return
+        #the won pixels as a one pixel wide image, so tables apply as usual
+        selected = np.take(encoded.reshape((-1, 1) + encoded.shape[2:]),
+                           where, axis=0)
+        color = apply_table(table, selected, vrange, values).reshape(-1, pixels.shape[1])
+        if lum is None:
+            # no luminance, direct insert
+            pixels[where] = color
+        else:
+            pixels[where] = color * (np.take(lum[:,:,1], where) / 255.0)[:,np.newaxis]
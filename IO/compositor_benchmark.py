@@ -0,0 +1,250 @@
+#==============================================================================
+# Copyright (c) 2015,  Kitware Inc., Los Alamos National Laboratory
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or other
+# materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may
+# be used to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#==============================================================================
+"""
+    Compares Compositor.render with the layer by layer compositing that it
+    replaced, on synthetic layers of a few resolutions and layer counts.
+
+    python compositor_benchmark.py [--sizes 1024 2048 4096] [--layers 2 4 8 16 32]
+
+    With --scaling it instead times tiled rendering with each of the given
+    numbers of worker threads.
+
+    python compositor_benchmark.py --scaling [--workers 1 2 4 8] [--tile-rows 256]
+"""
+
+import time
+import numpy as np
+from compositor import Compositor
+from lookup_table import lookup_table
+
+class LegacyCompositor(Compositor):
+    """ The layer by layer Compositor.render, kept for comparison. """
+
+    def render(self, layers, hasLayer):
+        l0 = layers[0]
+        c0 = np.copy(l0.getColor1(self.lookup_table))
+        lum0 = l0.getLuminance()
+        if lum0 is not None:
+            # modulate color of first layer by the luminance
+            lum0 = np.copy(lum0)
+            lum0 = self.diffuse(lum0)
+            c0[:,:,:] = c0[:,:,:] * (lum0[:,:,:]/255.0)
+
+        d0 = None
+        if hasLayer:
+            d0 = np.copy(l0.getDepth())
+            for idx in range(1, len(layers)):
+                cnext = layers[idx].getColor1(self.lookup_table)
+                dnext = layers[idx].getDepth()
+                lnext = layers[idx].getLuminance()
+                # put the top pixels into place
+                indices = np.where(dnext < d0)
+                if lnext is None:
+                    # no luminance, direct insert
+                    c0[indices[0],indices[1],:] = cnext[indices[0],indices[1],:]
+                else:
+                    # modulate color by luminance then insert
+                    lnext = self.diffuse(lnext)
+                    c0[indices[0], indices[1], :] = \
+                        cnext[indices[0], indices[1], :] * \
+                        (lnext[indices[0], indices[1], :] / 255.0)
+
+                d0[indices[0], indices[1]] = dnext[indices[0], indices[1]]
+
+        if d0 is not None:
+            #set background pixels to gray to avoid colormap
+            indices = np.where(d0>255)
+            c0[indices[0], indices[1], 0] = self._bgColor[0]
+            c0[indices[0], indices[1], 1] = self._bgColor[1]
+            c0[indices[0], indices[1], 2] = self._bgColor[2]
+
+        return c0
+
+class SyntheticLayer(object):
+    """ Stands in for a loaded LayerSpec. """
+    def __init__(self, color, depth, luminance, name=None):
+        self.color = color
+        self.depth = depth
+        self.luminance = luminance
+        self.name = name
+        self.lookupTable = None
+
+    def key(self):
+        return self.name
+
+    def getEncoded1(self):
+        return self.color, False, None
+
+    def getColor1(self, lookup_table):
+        if lookup_table is None:
+            return self.color
+        return lookup_table.recolor(self.color)
+
+    def getDepth(self):
+        return self.depth
+
+    def getLuminance(self):
+        return self.luminance
+
+def make_layers(size, count, distinct=4, seed=0):
+    """
+    Returns count layers of size x size pixels. Only a few distinct images
+    are made and shared among the layers to keep memory in check, so some
+    layers tie in depth, which also exercises the tie breaking. About a
+    quarter of each depth image is background (above 255).
+    """
+    rng = np.random.RandomState(seed)
+    images = []
+    for i in range(0, distinct):
+        color = rng.randint(0, 256, (size, size, 3)).astype(np.uint8)
+        depth = rng.uniform(0, 340, (size, size)).astype(np.float32)
+        luminance = rng.randint(0, 256, (size, size, 3)).astype(np.uint8)
+        images.append((color, depth, luminance))
+    layers = []
+    for i in range(0, count):
+        color, depth, luminance = images[i % distinct]
+        if i % 2:
+            #some layers have no luminance
+            luminance = None
+        layers.append(SyntheticLayer(color, depth, luminance, (seed, i)))
+    return layers
+
+def make_lookup_table():
+    """ a two color table, so that layers pay for recoloring like values do """
+    table = lookup_table()
+    table.luts.append({'name' : 'benchmark', 'colorspace' : 'RGB',
+                       'lut' : np.array([[0, 0, 255], [255, 0, 0]], dtype=np.uint8),
+                       'x' : [0.0, 0.5]})
+    table.set_table('benchmark')
+    return table
+
+def time_render(compositor, layers, repeat, prepare=None):
+    """
+    best wall clock time of repeat renders, and the last result. prepare,
+    if given, is called untimed before each render.
+    """
+    best = None
+    for i in range(0, repeat):
+        if prepare is not None:
+            prepare()
+        start = time.time()
+        result = compositor.render(layers, True)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def run(sizes=(1024, 2048, 4096), counts=(2, 4, 8, 16, 32), repeat=3):
+    """
+    prints a table comparing the two compositors, returns its rows. 'new'
+    is a render from scratch, 'edit' one in which a single layer changed
+    since the last render, so that in a viewer only that layer would be
+    loaded. Layers are recolored through a lookup table, as value layers
+    are.
+    """
+    rows = []
+    print "%6s %6s %10s %10s %10s %8s %6s" % \
+        ("size", "layers", "legacy s", "new s", "edit s", "speedup", "same")
+    for size in sizes:
+        for count in counts:
+            layers = make_layers(size, count)
+            compositors = []
+            for cls in [LegacyCompositor, Compositor]:
+                compositor = cls(max_bytes=2**40)
+                compositor.set_lookup_table(make_lookup_table())
+                compositor.set_background_color((127, 127, 127))
+                compositors.append(compositor)
+            legacy, expected = time_render(compositors[0], layers, repeat)
+            new, result = time_render(compositors[1], layers, repeat,
+                                      compositors[1].clear)
+            edits = []
+            def edit_one():
+                compositors[1].render(layers, True)
+                edits.append(None)
+                layers[-1].name = ('edited', len(edits))
+            edit, edited = time_render(compositors[1], layers, repeat, edit_one)
+            same = np.array_equal(expected, result) and \
+                np.array_equal(expected, edited)
+            rows.append((size, count, legacy, new, edit, same))
+            print "%6d %6d %10.4f %10.4f %10.4f %7.2fx %6s" % \
+                (size, count, legacy, new, edit, legacy / new, same)
+    return rows
+
+def run_scaling(sizes=(2048, 4096), counts=(8, 32), workers=(1, 2, 4, 8),
+                tile_rows=256, repeat=3):
+    """
+    prints a table of render times from scratch by number of worker
+    threads, with the speedup over the first, returns its rows
+    """
+    rows = []
+    print "%6s %6s %8s %10s %8s" % ("size", "layers", "workers", "s", "speedup")
+    for size in sizes:
+        for count in counts:
+            layers = make_layers(size, count)
+            base = None
+            for threads in workers:
+                compositor = Compositor(max_bytes=2**40, workers=threads,
+                                        tile_rows=tile_rows)
+                compositor.set_lookup_table(make_lookup_table())
+                compositor.set_background_color((127, 127, 127))
+                seconds, result = time_render(compositor, layers, repeat,
+                                              compositor.clear)
+                compositor.set_tiling(1)
+                if base is None:
+                    base = seconds
+                rows.append((size, count, threads, seconds))
+                print "%6d %6d %8d %10.4f %7.2fx" % \
+                    (size, count, threads, seconds, base / seconds)
+    return rows
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Time Compositor.render against the legacy compositor.")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1024, 2048, 4096],
+                        help="image widths and heights (default 1024 2048 4096)")
+    parser.add_argument("--layers", type=int, nargs="+",
+                        default=[2, 4, 8, 16, 32],
+                        help="layer counts (default 2 4 8 16 32)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="renders per measurement, the best is kept (default 3)")
+    parser.add_argument("--scaling", action="store_true",
+                        help="time tiled rendering by number of threads instead")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="thread counts for --scaling (default 1 2 4 8)")
+    parser.add_argument("--tile-rows", type=int, default=256,
+                        help="rows per tile for --scaling (default 256)")
+    args = parser.parse_args()
+    if args.scaling:
+        run_scaling(args.sizes, args.layers, args.workers, args.tile_rows,
+                    args.repeat)
+    else:
+        run(args.sizes, args.layers, args.repeat)
@@ -0,0 +1,242 @@
+#==============================================================================
+# Copyright (c) 2015,  Kitware Inc., Los Alamos National Laboratory
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or other
+# materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may
+# be used to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#==============================================================================
+"""
+    Module that converts stores from one type to another, for example
+    FileStore to SingleFileStore, streaming the documents through a
+    bounded window so that stores larger than memory can be converted.
+
+    python convert.py source/info.json dest/info.json --to SFS
+"""
+
+import sys
+import os
+import json
+import time
+import collections
+from multiprocessing.pool import ThreadPool
+import cinema_store
+
+STORE_TYPES = ['MFS', 'SFS', 'PACKED', 'SQLITE']
+
+def open_store(dbfilename):
+    """ loads the store at dbfilename, whatever its type """
+    with open(dbfilename, mode="rb") as file:
+        info_json = json.load(file)
+    store_type = "MFS"
+    if info_json.get("metadata"):
+        store_type = info_json["metadata"].get("store_type", "MFS")
+    if store_type == "SFS":
+        store = cinema_store.SingleFileStore(dbfilename)
+    elif store_type == "PACKED":
+        store = cinema_store.PackedFileStore(dbfilename)
+    elif store_type == "SQLITE":
+        store = cinema_store.SQLiteStore(dbfilename)
+    else:
+        store = cinema_store.FileStore(dbfilename)
+    store.load()
+    return store
+
+def make_store(source, dbfilename, store_type):
+    """
+    Makes a new, empty store of store_type at dbfilename with the same
+    parameters as source.
+    """
+    if not store_type in STORE_TYPES:
+        raise RuntimeError, "Invalid store type, must be one of %s" % \
+            str(STORE_TYPES)
+    if store_type == 'SFS':
+        if source.parameter_associations:
+            raise RuntimeError, \
+                "A SingleFileStore can not hold a store with dependent parameters"
+        #refuse now rather than after part of the volume is written
+        others = []
+        if source.determine_type({}) != 'RGB':
+            others.append(source.determine_type({}))
+        for name in sorted(source.parameter_list.keys()):
+            for value in source.get_parameter(name)['values']:
+                doctype = source.determine_type({name : value})
+                if doctype != 'RGB':
+                    others.append("%s=%s (%s)" % (name, str(value), doctype))
+        if others:
+            raise RuntimeError, \
+                "A SingleFileStore only holds RGB images, not %s" % \
+                ", ".join(others)
+        #raw volumes are written a slice at a time, vti ones all at once
+        dest = cinema_store.SingleFileStore(dbfilename, volume_format='raw')
+    else:
+        if store_type == 'PACKED':
+            dest = cinema_store.PackedFileStore(dbfilename)
+        elif store_type == 'SQLITE':
+            dest = cinema_store.SQLiteStore(dbfilename)
+        else:
+            dest = cinema_store.FileStore(dbfilename)
+        dest._set_parameter_associations(
+            json.loads(json.dumps(source.parameter_associations)))
+        dest._set_view_associations(
+            json.loads(json.dumps(source.view_associations)))
+    dest._set_parameter_list(json.loads(json.dumps(source.parameter_list)))
+    metadata = json.loads(json.dumps(source.metadata or {}))
+    for key in ['store_type', 'volume_format', 'dedupe', 'dedupe_ratio',
+                'pyramid_levels', 'external_data']:
+        metadata.pop(key, None)
+    dest.add_metadata(metadata)
+    if isinstance(dest, cinema_store.FileStore):
+        pattern = getattr(source, 'filename_pattern', None)
+        if not pattern:
+            names = sorted(source.parameter_list.keys())
+            pattern = "_".join(["{%s}" % name for name in names]) + ".png"
+        dest.filename_pattern = pattern
+    dest.create()
+    return dest
+
+def convert(source, dest, workers=4, window=16, progress=None,
+            checkpoint=None, checkpoint_every=100):
+    """
+    Copies every document of source into dest, in the order source finds
+    them. Up to window documents are decoded ahead, in parallel on workers
+    threads, while they are written to dest one at a time and in order, so
+    memory use stays bounded whatever the size of the store.
+
+    progress(done, total, nbytes, seconds) is called after each document.
+    With a checkpoint filename the number of documents done is recorded
+    there every checkpoint_every documents, after dest has been flushed,
+    and a later call with the same checkpoint skips them. The checkpoint
+    is removed once the conversion completes.
+    Returns (documents written, bytes written, seconds).
+    """
+    skip = 0
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint, mode="rb") as file:
+            skip = json.load(file)['done']
+
+    def record(done):
+        dest.flush()
+        with open(checkpoint + ".tmp", mode="wb") as file:
+            json.dump(dict(done = done), file)
+        os.rename(checkpoint + ".tmp", checkpoint)
+
+    total = source.count()
+    done = 0
+    written = 0
+    nbytes = 0
+    start = time.time()
+    pending = collections.deque()
+    pool = ThreadPool(workers)
+
+    def load(doc):
+        #touching data decodes it, on the pool's thread
+        doc.data
+        return doc
+
+    def write(doc):
+        """ inserts doc into dest, returns (documents, bytes) written """
+        if doc.data is None:
+            return 0, 0
+        dest.insert(cinema_store.Document(doc.descriptor, doc.data))
+        return 1, getattr(doc.data, 'nbytes', len(doc.data))
+
+    try:
+        for doc in source.find():
+            if doc is None or doc.missing:
+                #never written, source.count() leaves it out as well
+                continue
+            done = done + 1
+            if done <= skip:
+                #lazily found, so skipping costs no decoding
+                continue
+            pending.append(pool.apply_async(load, (doc,)))
+            if len(pending) < window:
+                continue
+            ndocs, ndata = write(pending.popleft().get())
+            written = written + ndocs
+            nbytes = nbytes + ndata
+            finished = done - len(pending)
+            if progress:
+                progress(finished, total, nbytes, time.time() - start)
+            if checkpoint and finished % checkpoint_every == 0:
+                record(finished)
+        while pending:
+            ndocs, ndata = write(pending.popleft().get())
+            written = written + ndocs
+            nbytes = nbytes + ndata
+            if progress:
+                progress(done - len(pending), total, nbytes, time.time() - start)
+    finally:
+        pool.close()
+        pool.join()
+
+    dest.flush()
+    dest.save()
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return written, nbytes, time.time() - start
+
+def convert_store(source_dbfilename, dest_dbfilename, store_type='SFS',
+                  workers=4, window=16, progress=None):
+    """
+    Converts the store at source_dbfilename into a store_type store at
+    dest_dbfilename, picking up where an interrupted run left off.
+    """
+    source = open_store(source_dbfilename)
+    checkpoint = os.path.join(os.path.dirname(dest_dbfilename),
+                              "convert.checkpoint")
+    if os.path.exists(checkpoint):
+        dest = open_store(dest_dbfilename)
+    else:
+        dest = make_store(source, dest_dbfilename, store_type)
+    return convert(source, dest, workers, window, progress, checkpoint)
+
+def _report(done, total, nbytes, seconds):
+    rate = done / seconds if seconds > 0 else 0.0
+    mbs = nbytes / seconds / 1e6 if seconds > 0 else 0.0
+    sys.stdout.write("\r%d/%d documents, %.1f docs/s, %.1f MB/s" %
+                     (done, total, rate, mbs))
+    sys.stdout.flush()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Convert a cinema store into another type of store.")
+    parser.add_argument("source", help="info.json of the store to read")
+    parser.add_argument("dest", help="info.json of the store to write")
+    parser.add_argument("--to", default="SFS", choices=STORE_TYPES,
+                        help="type of store to write (default SFS)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="decoding threads (default 4)")
+    parser.add_argument("--window", type=int, default=16,
+                        help="most documents held in memory (default 16)")
+    args = parser.parse_args()
+
+    written, nbytes, seconds = convert_store(args.source, args.dest, args.to,
+                                             args.workers, args.window,
+                                             _report)
+    print
+    print "wrote %d documents, %.1f MB in %.1f s" % \
+        (written, nbytes / 1e6, seconds)
@@ -30,6 +30,7 @@
 import cinema_store
 import itertools
 import json
+import numpy as np
 
 class Explorer(object):
     """
@@ -91,6 +92,8 @@ class Explorer(object):
         if self.tracks:
             for e in self.tracks:
                 res = e.finish()
+        #wait for background writes, and report any that failed
+        self.cinema_store.flush()
 
     def insert(self, doc):
         self.cinema_store.insert(doc)
@@ -154,3 +157,17 @@ class Layer(Track):
                     obj.callHide()
                 except TypeError:
                     obj.callHide(obj)
+
+def value_image(rgb, vrange):
+    """
+    Turns a value capture, in which each pixel's 24 bit RGB code holds
+    the value scaled over vrange (min, max) and 0 means no value, back
+    into float32 values. Pixels without a value become NaN.
+    """
+    code = np.left_shift(rgb[:,:,0].astype(np.uint32), 16)
+    code = np.bitwise_or(code, np.left_shift(rgb[:,:,1].astype(np.uint32), 8))
+    code = np.bitwise_or(code, rgb[:,:,2])
+    values = (code.astype(np.float64) - 1) / 0xFFFFFE
+    values = vrange[0] + values * (vrange[1] - vrange[0])
+    values[code == 0] = np.nan
+    return values.astype(np.float32)
@@ -31,11 +31,62 @@ import json
 import numpy as np
 import math
 
+def value_range(values, vrange=None):
+    """
+    Returns vrange, or the (min, max) of the finite values in the image
+    when vrange is None or incomplete, or None when there are none.
+    """
+    if vrange is None or vrange[0] is None or vrange[1] is None:
+        values = np.asarray(values, np.float32)
+        finite = values[np.isfinite(values)]
+        if finite.size == 0:
+            return None
+        vrange = (finite.min(), finite.max())
+    return vrange
+
+def normalize_values(values, vrange=None):
+    """
+    Scale a float value image to [0,1] over vrange, the (min, max) the
+    values were recorded for, or over the image's own extent if vrange
+    is None. Pixels without a value (NaN) stay NaN.
+    """
+    values = np.asarray(values, np.float32)
+    vrange = value_range(values, vrange)
+    if vrange is None:
+        return values
+    lo = float(vrange[0])
+    hi = float(vrange[1])
+    scale = 1.0/(hi - lo) if hi != lo else 0.0
+    return np.clip((values - lo) * scale, 0.0, 1.0)
+
+def gray_values(values, vrange=None):
+    """ Show a float value image as a gray RGB image, see normalize_values. """
+    gray = np.nan_to_num(normalize_values(values, vrange) * 255).astype(np.uint8)
+    return np.dstack((gray, gray, gray))
+
+def apply_table(table, encoded, vrange=None, values=False):
+    """
+    Colors an image with table, or without one shows it as it is. With
+    values, encoded holds float values scaled over vrange (see
+    normalize_values), which are shown in gray without a table. Otherwise
+    it holds 24-bit values encoded as RGB, or plain RGB colors.
+    """
+    if values:
+        if table is None:
+            return gray_values(encoded, vrange)
+        return table.recolor_values(encoded, vrange)
+    if table is None:
+        return encoded
+    return table.recolor(encoded)
+
 class lookup_table:
     def __init__(self):
         self.luts = []
         self.lut = None
         self.x = None
+        self.name = None
+        self._bins = None
+        self._dense = None
 
         # Add a 'None' colormap
         lutentry = {}
@@ -70,12 +121,68 @@ class lookup_table:
 
     def set_table(self, name):
         self.lut = None
+        self.name = None
+        self._bins = None
+        self._dense = None
         for lut in self.luts:
             if lut['name'] == name:
                 self.lut = lut['lut']
                 self.x = lut['x']
+                self.name = name
+                if self.lut is not None:
+                    self._compile()
                 return
 
+    def _compile(self):
+        """
+        Prepares the current table for recolor. Besides the bins that
+        digitize needs, makes a color for each of the 65536 buckets of 256
+        consecutive 24-bit values, so that recolor becomes a lookup on the
+        top 16 bits of the values. The few buckets that a bin edge splits
+        are marked, their pixels are given the exact bin of their value.
+        """
+        bins = list(self.x)
+        if self.x[-1] < 1.0:
+            bins.append(1.0)
+        else:
+            bins.append(1.01) # 1.0 gets its own color so need an extra bin
+        self._bins = np.array(bins, dtype=np.float64)
+        if not np.all(np.diff(self._bins) > 0):
+            #leave tables that are not increasing to digitize
+            return
+        #the first 24-bit value at or above each edge
+        self._edges = np.array([self._first_value_at(edge) for edge in bins],
+                               dtype=np.int64)
+        #recolor reads the red and green bytes of a pixel as one native
+        #16-bit number, so order the buckets the way those read
+        pairs = np.arange(1 << 16, dtype=np.uint16).view(np.uint8).reshape(-1, 2)
+        starts = (pairs[:,0].astype(np.int64) << 16) | (pairs[:,1].astype(np.int64) << 8)
+        first = self._bin_of(starts)
+        self._dense = self.lut[first]
+        self._mixed = first != self._bin_of(starts + 255)
+
+    @staticmethod
+    def _normalized(value):
+        """ where a 24-bit value falls in the table, as recolor has it """
+        return float(value - 1) / 0xFFFFFE #0 is reserved as "nothing"
+
+    def _first_value_at(self, edge):
+        value = int(math.ceil(min(max(edge, -1.0), 2.0) * 0xFFFFFE)) + 1
+        value = min(max(value, 0), 1 << 24)
+        #settle float rounding either way
+        while value > 0 and self._normalized(value - 1) >= edge:
+            value -= 1
+        while value < (1 << 24) and self._normalized(value) < edge:
+            value += 1
+        return value
+
+    def _bin_of(self, values):
+        """ the entry of the table for 24-bit values, the same as digitize gives """
+        idx = np.searchsorted(self._edges, values, side='right') - 1
+        #below the first or past the last bin
+        idx[(idx < 0) | (idx >= len(self.lut))] = len(self.lut) - 1
+        return idx
+
     def names(self):
         """
         Return an array of the names of all available lookup tables.
@@ -90,6 +197,23 @@ class lookup_table:
             # No lut, so don't recolor
             return rgbVarr
 
+        if (self._dense is not None and rgbVarr.dtype == np.uint8 and
+            rgbVarr.ndim == 3 and rgbVarr.shape[2] == 3):
+            rgbVarr = np.ascontiguousarray(rgbVarr)
+            h, w = rgbVarr.shape[0:2]
+            # red and green, the top 16 bits, pick the bucket of 256 values
+            bucket = np.ndarray((h, w), dtype=np.uint16, buffer=rgbVarr,
+                                strides=(w*3, 3)).astype(np.intp)
+            colors = np.take(self._dense, bucket, axis=0, mode='clip')
+            split = np.flatnonzero(np.take(self._mixed, bucket, mode='clip'))
+            if len(split):
+                # blue decides in the buckets that a bin edge splits
+                rgb = rgbVarr.reshape(-1, 3)[split].astype(np.int64)
+                value = (rgb[:,0] << 16) | (rgb[:,1] << 8) | rgb[:,2]
+                colors.reshape(-1, colors.shape[-1])[split] = \
+                    self.lut[self._bin_of(value)]
+            return colors
+
         #print "rgbVarr", rgbVarr.dtype, rgbVarr.shape
         w0 = np.left_shift(rgbVarr[:,:,0].astype(np.uint32),16)
         #print "w0", w0.dtype, w0.shape, w0.min(), w0.max()
@@ -105,16 +229,30 @@ class lookup_table:
         normalized_val = np.divide(value.astype(float),0xFFFFFE)
         #print ("norm", normalized_val.dtype,
         #       normalized_val.shape, normalized_val.min(), normalized_val.max())
+        return self._lookup(normalized_val)
+
+    def recolor_values(self, values, vrange=None):
+        """
+        Color a float value image, vrange is the (min, max) that spans the
+        table. Without a table the values are shown in gray.
+        """
+        if self.lut is None:
+            return gray_values(values, vrange)
+        return self._lookup(normalize_values(values, vrange))
+
+    def _lookup(self, normalized_val):
         #idx = np.multiply(normalized_val,len(self.lut)).astype(int)
         #print "idx", idx.dtype, idx.shape, idx.min(), idx.max(), len(lut)
 
         # use a histogram to support non-uniform colormaps (fetch bin indices)
         #shape = normalized_val.shape
-        bins = list(self.x)
-        if self.x[-1] < 1.0:
-            bins.append(1.0)
-        else:
-            bins.append(1.01) # 1.0 gets its own color so need an extra bin
+        bins = self._bins
+        if bins is None:
+            bins = list(self.x)
+            if self.x[-1] < 1.0:
+                bins.append(1.0)
+            else:
+                bins.append(1.01) # 1.0 gets its own color so need an extra bin
         #print 'self.x = ', self.x
         #print 'bins = ', bins
         idx = np.digitize(normalized_val.flatten(), bins)
@@ -0,0 +1,242 @@
+#==============================================================================
+# Copyright (c) 2015,  Kitware Inc., Los Alamos National Laboratory
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or other
+# materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may
+# be used to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#==============================================================================
+"""
+    Module that decodes documents in the background, ahead of an
+    interactive viewer asking for them.
+"""
+
+import threading
+import Queue
+
+class Prefetcher(object):
+    """
+    Keeps a pool of worker threads decoding the documents next to the one
+    being viewed, so that they are already in the store's decode cache by
+    the time the user steps onto them.
+
+    Call update() with the viewer's current query whenever it changes, and
+    with the pyramid level it shows, so that what is decoded ahead is what
+    the viewer will ask for.
+    Parameters whose value changed since the previous call are taken to be
+    moving and the next 'lookahead' values in their direction of motion
+    are queued, along with every layer and field at those values. Up to
+    max_bytes are decoded ahead of each position. Queued work is dropped
+    when a parameter reverses direction or a different set of parameters
+    starts moving.
+    """
+    def __init__(self, store, workers=2, max_bytes=64*1024*1024,
+                 lookahead=2, cyclic=['phi']):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.lookahead = lookahead
+        #parameters that wrap around from the last value to the first
+        self.cyclic = cyclic
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._level = 0
+        self._nbytes = 0
+        self._queued = set()
+        self._previous = None
+        self._directions = {}
+        self._workers = []
+        #without a decode cache there is nowhere to keep what we decode
+        self.enabled = getattr(store, 'decode_cache', None) is not None
+        if not self.enabled:
+            return
+        for i in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        """ cancel outstanding work and shut the workers down """
+        self.cancel()
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def cancel(self):
+        """ forget everything queued so far """
+        with self._lock:
+            self._generation = self._generation + 1
+            self._nbytes = 0
+            self._queued = set()
+
+    def update(self, query, level=0):
+        """
+        Tell the prefetcher where the viewer is now. Values in query may be
+        single values or, as the Qt viewer keeps them, sets of values.
+        level is the pyramid level the viewer reads documents at.
+        """
+        if not self.enabled:
+            return
+        if level != self._level:
+            #what was queued is at a resolution no longer shown
+            self.cancel()
+            self._level = level
+        base = self._base_query(query)
+        previous = self._previous
+        self._previous = base
+        if previous is None:
+            return
+        if set(base.keys()) != set(previous.keys()):
+            self.cancel()
+            self._directions = {}
+            return
+
+        moved = {}
+        for name, value in base.iteritems():
+            if previous[name] != value:
+                direction = self._direction(name, previous[name], value)
+                if direction != 0:
+                    moved[name] = direction
+        if moved:
+            if moved != self._directions:
+                #turned around, or something else is moving now
+                self.cancel()
+            self._directions = moved
+        ahead = []
+        for step in range(1, self.lookahead + 1):
+            diagonal = dict(base)
+            for name, direction in self._directions.iteritems():
+                value = self._step(name, base[name], direction * step)
+                if value is None:
+                    diagonal = None
+                    continue
+                neighbor = dict(base)
+                neighbor[name] = value
+                ahead.append(neighbor)
+                if diagonal is not None:
+                    diagonal[name] = value
+            if diagonal is not None and len(self._directions) > 1:
+                ahead.append(diagonal)
+
+        window = set(self._key(query) for query in ahead)
+        with self._lock:
+            #budget is for what lies ahead of the new position
+            self._nbytes = 0
+            #only remember what is still ahead, so that the set stays small
+            #and positions we come back to later are fetched again
+            self._queued &= window
+        for query in ahead:
+            self._enqueue(query)
+
+    def _base_query(self, query):
+        """
+        The part of query that selects a single position, that is
+        everything that is neither a layer nor depends on another parameter.
+        """
+        store = self.store
+        base = {}
+        for name, value in query.iteritems():
+            if not name in store.parameter_list:
+                continue
+            if store.isdepender(name) or store.islayer(name):
+                continue
+            if isinstance(value, (set, frozenset, list, tuple)):
+                if len(value) != 1:
+                    continue
+                value = next(iter(value))
+            base[name] = value
+        return base
+
+    def _direction(self, name, old, new):
+        values = self.store.get_parameter(name)['values']
+        try:
+            delta = values.index(new) - values.index(old)
+        except ValueError:
+            return 0
+        if name in self.cyclic:
+            #take the short way around
+            count = len(values)
+            if delta > count / 2:
+                delta = delta - count
+            elif delta < -count / 2:
+                delta = delta + count
+        if delta > 0:
+            return 1
+        if delta < 0:
+            return -1
+        return 0
+
+    def _step(self, name, value, offset):
+        """ the value offset positions away, or None when past the end """
+        values = self.store.get_parameter(name)['values']
+        try:
+            idx = values.index(value) + offset
+        except ValueError:
+            return None
+        if name in self.cyclic:
+            return values[idx % len(values)]
+        if idx < 0 or idx >= len(values):
+            return None
+        return values[idx]
+
+    @staticmethod
+    def _key(query):
+        return tuple(sorted(query.items()))
+
+    def _enqueue(self, query):
+        key = self._key(query)
+        with self._lock:
+            if key in self._queued:
+                return
+            self._queued.add(key)
+            generation = self._generation
+        self._queue.put((generation, self._level, query))
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            generation, level, query = task
+            try:
+                if level:
+                    docs = self.store.find(query, level=level)
+                else:
+                    docs = self.store.find(query)
+                for doc in docs:
+                    if (generation != self._generation or
+                        self._nbytes > self.max_bytes):
+                        break
+                    if doc is None:
+                        continue
+                    data = doc.data
+                    if hasattr(data, 'nbytes'):
+                        with self._lock:
+                            self._nbytes = self._nbytes + data.nbytes
+            except Exception:
+                #a prefetch is only a hint, the viewer will report real errors
+                pass
@@ -52,6 +52,8 @@ class ImageExplorer(explorers.Explorer):
         self.view = view
         self.CaptureDepth = False
         self.CaptureLuminance = False
+        self.CaptureValues = False
+        self.ValueRange = None
 
     def insert(self, document):
         if not self.view:
@@ -87,6 +89,10 @@ class ImageExplorer(explorers.Explorer):
             width = ext[1] - ext[0] + 1
             height = ext[3] - ext[2] + 1
             imageslice = np.flipud(idata.reshape(height,width,3))
+            if (self.CaptureValues and
+                self.cinema_store.determine_type(document.descriptor) == 'VALUE'):
+                #store the values themselves, not their color encoding
+                imageslice = explorers.value_image(imageslice, self.ValueRange)
             #import Image
             #img = Image.fromarray(imageslice)
             #img.show()
@@ -98,6 +104,7 @@ class ImageExplorer(explorers.Explorer):
         super(ImageExplorer, self).insert(document)
 
     def setDrawMode(self, choice, **kwargs):
+        self.CaptureValues = False
         if choice == 'color':
             self.view.StopCaptureValues()
             self.CaptureDepth=False
@@ -118,6 +125,8 @@ class ImageExplorer(explorers.Explorer):
             self.view.StartCaptureValues()
             self.CaptureDepth = False
             self.CaptureLuminance = False
+            self.CaptureValues = True
+            self.ValueRange = kwargs['range']
 
     def finish(self):
         super(ImageExplorer, self).finish()
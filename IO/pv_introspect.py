@@ -140,7 +140,7 @@ def make_cinema_store(levels, ocsfname, _phis=None, _thetas=None):
                 if not arrName == "Normals":
                     for i in range(0, arr.GetNumberOfComponents()):
                         fName = arrName+"_"+str(i) 
-                        fields[fName] = 'value'
+                        fields[fName] = 'floatvalue'
                         ranges[fName] = arr.GetRange(i)
                         if defaultName == None:
                             defaultName = fName
@@ -151,7 +151,7 @@ def make_cinema_store(levels, ocsfname, _phis=None, _thetas=None):
                 if not arrName == "Normals":
                     for i in range(0, arr.GetNumberOfComponents()):
                         fName = arrName+"_"+str(i) 
-                        fields[fName] = 'value'
+                        fields[fName] = 'floatvalue'
                         ranges[fName] = arr.GetRange(i)
                         if defaultName == None:
                             defaultName = fName
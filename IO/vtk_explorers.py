@@ -51,6 +51,8 @@ class ImageExplorer(explorers.Explorer):
         self.w2i.SetInput(self.rw)
         self.vp = None
         self.lp = None
+        self.CaptureValues = False
+        self.ValueRange = None
 
     def insert(self, document):
         r = self.rw.GetRenderers().GetFirstRenderer()
@@ -69,11 +71,16 @@ class ImageExplorer(explorers.Explorer):
             imageslice = np.flipud(idata.reshape(width,height))
         else:
             imageslice = np.flipud(idata.reshape(width,height,image.GetNumberOfScalarComponents()))
+        if (self.CaptureValues and
+            self.cinema_store.determine_type(document.descriptor) == 'VALUE'):
+            #store the values themselves, not their color encoding
+            imageslice = explorers.value_image(imageslice, self.ValueRange)
         document.data = imageslice
         super(ImageExplorer, self).insert(document)
 
     def setDrawMode(self, choice, **kwargs):
         self.rw.GetRenderers().GetFirstRenderer().SetPass(None)
+        self.CaptureValues = False
         if choice == 'color':
             self.w2i.SetInputBufferTypeToRGB()
         if choice == 'depth':
@@ -86,6 +93,8 @@ class ImageExplorer(explorers.Explorer):
             self.vp.SetInputComponentToProcess(kwargs['component'])
             #self.vp.SetScalarRange(kwargs['range'][0],kwargs['range'][1])
             self.rw.GetRenderers().GetFirstRenderer().SetPass(self.vp)
+            self.CaptureValues = True
+            self.ValueRange = kwargs['range']
         if choice == 'luminance':
             self.w2i.SetInputBufferTypeToRGB()
             if not self.lp:
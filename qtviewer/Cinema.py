@@ -50,6 +50,10 @@ storeType = "MFS"
 try:
     if info_json["metadata"]["store_type"] == "SFS":
         cs = cinema_store.SingleFileStore(sys.argv[1])
+    elif info_json["metadata"]["store_type"] == "PACKED":
+        cs = cinema_store.PackedFileStore(sys.argv[1])
+    elif info_json["metadata"]["store_type"] == "SQLITE":
+        cs = cinema_store.SQLiteStore(sys.argv[1])
     else:
         raise TypeError
 except(TypeError,KeyError):
@@ -31,7 +31,6 @@ from PySide import QtCore
 from PySide.QtCore import *
 from PySide.QtGui import *
 
-import itertools
 import copy
 import numpy as np
 import PIL
@@ -40,6 +39,7 @@ from PySide.QtGui import QColorDialog
 from cinema_python.compositor import *
 from cinema_python.lookup_table import *
 from cinema_python.LayerSpec import *
+from cinema_python.prefetch import Prefetcher
 from QRenderView import *
 from RenderViewMouseInteractor import *
 import math
@@ -75,6 +75,11 @@ class MainWindow(QMainWindow):
         #keep track of widgets that depend on others for easy updating
         self._dependent_widgets = {}
 
+        # decodes ahead of the user, made for each store in setStore
+        self._prefetcher = None
+        self._layerLoader = None
+        self._compositor = None
+
         # create lookup tables
         self.lookup_table = lookup_table()
         self.lookup_table.read('builtin_tables.json')
@@ -92,6 +97,9 @@ class MainWindow(QMainWindow):
         # Set up render view interactor
         self._mouseInteractor = RenderViewMouseInteractor()
 
+        # Coarsest image pyramid level to show when zoomed out
+        self._maxLevel = 3
+
     # Create the menu bars
     def createMenus(self):
         # File menu
@@ -105,6 +113,21 @@ class MainWindow(QMainWindow):
         self._store = store
         self._initializeCurrentQuery()
 
+        # Decode neighboring images while the user browses
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+        self._prefetcher = Prefetcher(store)
+
+        # Load all of a frame's images in parallel
+        if self._layerLoader is not None:
+            self._layerLoader.close()
+        self._layerLoader = LayerLoader()
+
+        # Keeps the layers of recent frames, only changed ones are redone
+        if self._compositor is not None:
+            self._compositor.close()
+        self._compositor = Compositor()
+
         # Disconnect all mouse signals in case the store has no phi or theta values
         self._disconnectMouseSignals()
 
@@ -540,19 +563,9 @@ class MainWindow(QMainWindow):
 
 
     def _view_dependencies_satisfied(self, name):
-        #translate the sets we use for parameters of the query
-        #then call the same named method on the store
-        #TODO: using sets for everything to do options, but probably better if the store supported it
-        params = []
-        values = []
-        for n,vs in self._currentQuery.iteritems():
-            params.append(n)
-            values.append(vs)
-        for element in itertools.product(*values):
-            q = dict(itertools.izip(params, element))
-            if self._store.view_dependencies_satisfied(name, q):
-                return True
-        return False
+        #the query holds a set of values for each parameter (for options),
+        #ask the store whether any combination of them satisfies name
+        return self._store.view_dependencies_satisfiable(name, self._currentQuery)
 
     # Update enable state of all dependent widgets
     def _updateDependentWidgets(self):
@@ -758,13 +771,17 @@ class MainWindow(QMainWindow):
         self._updateSlider('phi', phi)
         self._updateSlider('theta', theta)
 
-        scale = self._mouseInteractor.getScale()
-        self._displayWidget.resetTransform()
-        self._displayWidget.scale(scale, scale)
-
         self.colorbar.update()
         self.render()
 
+    # Pick the coarsest image level that still gives a pixel per screen pixel
+    def _pyramidLevel(self):
+        scale = self._mouseInteractor.getScale()
+        level = 0
+        while level < self._maxLevel and scale * 2 ** (level + 1) <= 1.0:
+            level = level + 1
+        return level
+
     # Perform query requested of the UI
     # retrieve documents that go into the result,
     # display the retrieved image.
@@ -835,6 +852,9 @@ class MainWindow(QMainWindow):
                                         img_type = self._store.determine_type({x:c})
                                         #print "add", img_type, x, c
                                         lquery.addQuery(img_type, x, c)
+                                        if img_type == 'VALUE':
+                                            ranges = dd[x].get('valueRanges', {})
+                                            lquery.setValueRange(ranges.get(c))
                                     layers.append(lquery)
                 #else:
                 #    print "NO FIELDS"
@@ -843,22 +863,21 @@ class MainWindow(QMainWindow):
         if not hasLayer:
             layers.append(base_query)
 
-        #send queries to the store to obtain images
-        lcnt = 0
-        for l in range(0,len(layers)):
-            layers[l].loadImages(self._store)
-            #print "loaded layer", lcnt,
-            #layers[l].printme()
-            lcnt +=1
+        c = self._compositor
+        c.set_lookup_table(self.lookup_table)
+        c.set_background_color(self._bgColor)
+
+        #send queries to the store to obtain images, except for the
+        #layers the compositor still has from earlier frames
+        level = self._pyramidLevel()
+        self._layerLoader.load(self._store, layers, level, c.is_cached)
+        #for t in self._layerLoader.timings: print "loaded", t
 
         if len(layers) == 0:
             self._displayWidget.setPixmap(None)
             self._displayWidget.setAlignment(Qt.AlignCenter)
             return
 
-        c = Compositor()
-        c.set_lookup_table(self.lookup_table)
-        c.set_background_color(self._bgColor)
         c0 = c.render(layers,hasLayer)
 
         # show the result
@@ -869,3 +888,11 @@ class MainWindow(QMainWindow):
         # Try to resize the display widget
         self._displayWidget.sizeHint = pix.size
         self._displayWidget.setPixmap(pix)
+
+        # Reduced images are shown enlarged to keep the on screen size
+        scale = self._mouseInteractor.getScale() * 2 ** level
+        self._displayWidget.resetTransform()
+        self._displayWidget.scale(scale, scale)
+
+        # Get a head start on where the user is heading
+        self._prefetcher.update(self._currentQuery, level)